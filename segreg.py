@@ -25,13 +25,29 @@ from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 from qgis.utils import *
 import numpy as np
-from scipy.spatial.distance import cdist
 
 # Initialize Qt resources from file resources.py
 import resources
 # Import the code for the dialog
 from segreg_dialog import SegregDialog
+from segreg_intensity import ENGINES, PRECISIONS, kernelWeight, regularLattice
+from segreg_cache import SegregCache
+from segreg_engine import SegregEngine
+from segreg_output import outputFormat, outputFormats, writeGlobal, writeTable
+from segreg_profile import StageProfile, profiled
+from segreg_worker import SegregWorker
+import datetime
+import hashlib
+import multiprocessing
 import os.path
+import shutil
+import tempfile
+
+# measures by the name of their check box on the dialog
+MEASURE_FLAGS = {'diss_local': 'local_dissimilarity', 'diss_global': 'global_dissimilarity',
+                 'expo_local': 'local_exposure', 'expo_global': 'global_exposure',
+                 'entro_local': 'local_entropy', 'entro_global': 'global_entropy',
+                 'idxh_local': 'local_indexh', 'idxh_global': 'global_indexh'}
 
 
 class Segreg:
@@ -74,28 +90,20 @@ class Segreg:
         self.model = QStandardItemModel(self.dlg.lvGroups)
         self.lvGroups.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.confirmedLayerName = None
+        self.confirmedIdName = None
+        self.scratchDir = None
+        self.profile = StageProfile()
+        self.thread = None
+        self.worker = None
         self.dlg.plainTextEdit.setReadOnly(True)
+        self.dlg.plainTextEdit.setFont(QFont('Courier'))
+        self.infoText = self.dlg.plainTextEdit.toPlainText()
+        self.dlg.sbWorkers.setMaximum(multiprocessing.cpu_count())
 
-        # Segregation measures attributes
-        self.attributeMatrix = np.matrix([])    # attributes matrix full size - all columns
-        self.location = []                      # x and y coordinates from tract centroid (2D lists)
-        self.pop = []                           # population of each groups by tract (2D lists)
-        self.pop_sum = []                       # total population of the tract (sum all groups)
-        self.locality = []                      # population intensity by groups by tract
-        self.n_location = 0                     # length of list (n lines) (attributeMatrix.shape[0])
-        self.n_group = 0                        # number of groups (attributeMatrix.shape[1] - 4)
-        self.costMatrix = []                    # scipy cdist distance matrix
-        self.tract_id = []                      # tract ids in string format
-
-        # Local and global internals
-        self.local_dissimilarity = []
-        self.local_exposure = []
-        self.local_entropy = []
-        self.local_indexh = []
-        self.global_dissimilarity = []
-        self.global_exposure = []
-        self.global_entropy = []
-        self.global_indexh = []
+        # input, intensity and measures of the run, computed without Qt
+        self.core = SegregEngine()
+        self.outOfCore = False                  # memory-mapped arrays on the scratch directory
+        self.measureFlags = {}                  # measures checked on the dialog by name
 
     # noinspection PyMethodMayBeStatic
     def tr(self, message):
@@ -184,6 +192,9 @@ class Segreg:
         self.dlg.leOutput.clear()
         self.dlg.pbOpenPath.clicked.connect(self.saveResults)
 
+        # stop the computation running in background
+        self.dlg.pbCancel.clicked.connect(self.cancelTask)
+
         # clear variables at exit
         self.dlg.dbClose.clicked.connect(self.clearVariables)
 
@@ -200,14 +211,11 @@ class Segreg:
 
     def clearVariables(self):
         """clear local lists and variables"""
-        # clear input tables
-        self.location = []
-        self.pop = []
-        self.pop_sum = []
-        self.locality = []
-        self.n_location = 0
-        self.n_group = 0
-        self.tract_id = []
+        # stop a computation still running in background
+        self.cancelTask(wait=True)
+
+        # clear input tables and results
+        self.core.clear()
         self.selectedFields = []
         self.layers = []
 
@@ -215,20 +223,20 @@ class Segreg:
         self.dlg.leOutput.clear()
         self.model.clear()
         self.dlg.leBandwidht.clear()
+        self.dlg.leTolerance.clear()
+        self.dlg.leExposurePairs.clear()
         for button in self.dlg.gbLocal.findChildren(QCheckBox):
             button.setChecked(False)
         for button in self.dlg.gbGlobal.findChildren(QCheckBox):
             button.setChecked(False)
 
-        # clear result tables
-        self.local_dissimilarity = []
-        self.local_exposure = []
-        self.local_entropy = []
-        self.local_indexh = []
-        self.global_dissimilarity = []
-        self.global_exposure = []
-        self.global_entropy = []
-        self.global_indexh = []
+        # log the stages of the previous run
+        self.finishProfile()
+
+        # remove memory-mapped files of the previous run
+        if self.scratchDir is not None:
+            shutil.rmtree(self.scratchDir, ignore_errors=True)
+            self.scratchDir = None
 
     def addLayers(self):
         """
@@ -274,7 +282,7 @@ class Segreg:
             self.dlg.cbId.addItems(fields)
             self.dlg.lvGroups.setModel(self.model)
 
-        except:
+        except Exception:
             return
 
     def selectGroups(self):
@@ -292,13 +300,17 @@ class Segreg:
     def checkSelectedGroups(self):
         """Check if groups were selected and confirmed before moving to measures tab"""
         if self.dlg.tabWidget.currentIndex() == 1:
-            if len(self.pop) == 0:
+            if len(self.core.pop) == 0:
                 self.dlg.tabWidget.setTabEnabled(1, False)
                 msg = "Please select and confirm the attributes at Input Parameters tab!"
                 QMessageBox.critical(None, "Error", msg)
 
+    @profiled('confirmButton')
     def confirmButton(self):
         """Populate local variables (attributes matrix) with selected fields"""
+        # a new input starts a new run
+        self.finishProfile()
+
         # get layer and fields from combo box items
         layerName = self.dlg.cbLayers.currentText()
         selectedLayer = QgsMapLayerRegistry.instance().mapLayersByName(layerName)[0]
@@ -306,54 +318,275 @@ class Segreg:
         # to be used later to save results as shapefile
         self.confirmedLayerName = layerName
 
-        # populate tract_id data
-        id_name = self.dlg.cbId.currentText()
-        id_values = selectedLayer.getValues(id_name)[0]
-        id_values = [str(x) for x in id_values]
-        self.tract_id = np.asarray(id_values)
-        self.tract_id = self.tract_id.reshape((len(id_values), 1))
-
-        # return x and y from polygons centroids
-        x_cord = [feat.geometry().centroid().asPoint().x() for feat in selectedLayer.getFeatures()]
-        x_cord = np.reshape(x_cord, (len(x_cord), 1))
-        y_cord = [feat.geometry().centroid().asPoint().y() for feat in selectedLayer.getFeatures()]
-        y_cord = np.reshape(y_cord, (len(y_cord), 1))
-
-        # populate groups data based on selected fields list
-        groups = []
-        for i in field_names:
-            values = selectedLayer.getDoubleValues(i)[0]  # getDoubleValues for float
-            group = [float(x) for x in values]
-            groups.append(group)
-        groups = np.asarray(groups).T
-
         # check if fields were selected
-        if len(groups) == 0:
+        if len(field_names) == 0:
             QMessageBox.critical(None, "Error", 'No data selected!')
             self.dlg.tabWidget.setTabEnabled(1, False)
             return
 
-        # concatenate values and populate attribute matrix
-        data = np.concatenate((x_cord, y_cord, groups), axis=1)
-        self.attributeMatrix = np.asmatrix(data)
-        n = self.attributeMatrix.shape[1]
-        self.location = self.attributeMatrix[:, 0:2]
-        self.location = self.location.astype('float')
-        self.pop = self.attributeMatrix[:, 2:n]
-        self.pop[np.where(self.pop < 0)[0], np.where(self.pop < 0)[1]] = 0.0
-        self.n_group = n - 2
-        self.n_location = self.attributeMatrix.shape[0]
-        self.pop_sum = np.sum(self.pop, axis=1)
+        # read ids, groups, centroids and the geometry hash used as cache key in
+        # a single pass. Centroids are skipped when the geometry hash last read
+        # from this layer source has cached centroids, and read again in the
+        # rare case the geometry has changed since
+        id_name = self.dlg.cbId.currentText()
+        self.confirmedIdName = id_name
+        cache = self.openCache()
+        geometryKey = None
+        if cache is None:
+            tract_id, centroid, groups = self.readFeatures(selectedLayer, id_name, field_names)
+        else:
+            sourceKey = cache.key(selectedLayer.source(), 'geometry')
+            known = cache.load(sourceKey)
+            cached = None
+            if known is not None:
+                cached = cache.load(cache.key(str(known['digest']), 'centroid'))
+            digest = hashlib.sha1()
+            tract_id, centroid, groups = self.readFeatures(selectedLayer, id_name, field_names,
+                                                           digest, cached is None)
+            geometryKey = digest.hexdigest()
+            if cached is not None and str(known['digest']) == geometryKey:
+                centroid = np.concatenate((cached['x'], cached['y']), axis=1)
+            else:
+                if centroid is None:
+                    centroid = self.readCentroids(selectedLayer)
+                cache.save(cache.key(geometryKey, 'centroid'),
+                           x=centroid[:, 0:1], y=centroid[:, 1:2])
+                cache.save(sourceKey, digest=np.asarray(geometryKey))
+
+        # populate the engine input, weight operators are kept while the
+        # centroids don't change
+        self.core.cache = cache
+        self.core.setInput(tract_id, centroid, groups, geometryKey)
 
         # unlock measures tab and display confirmation if success
-        if self.attributeMatrix is not None:
+        if self.core.attributeMatrix is not None:
             self.dlg.tabWidget.setTabEnabled(1, True)
             self.iface.messageBar().pushMessage("Info",
              "Input saved", level=QgsMessageBar.INFO, duration=2)
 
+    def readOptions(self):
+        """
+        Read the options of the computations from the dialog, before they start
+        on a worker thread where widgets must not be used. The scratch directory
+        is created here as well.
+        """
+        self.core.memory = self.dlg.sbMemory.value()
+        self.outOfCore = self.dlg.cbMemmap.isChecked()
+        self.core.precision = PRECISIONS[self.dlg.cbPrecision.currentIndex()]
+        self.measureFlags = {}
+        for name in MEASURE_FLAGS:
+            self.measureFlags[name] = getattr(self.dlg, name).isChecked()
+        self.core.scratch = self.scratchDirectory()
+
+    def startTask(self, function, done):
+        """
+        Run a computation on a worker thread so QGIS keeps responding. Its
+        progress is shown on the dialog progress bar and the Cancel button stops
+        it at its next block of rows. The computation sets its results on this
+        instance and done(result) is then called on the GUI thread. Input and
+        run buttons are disabled meanwhile.
+        :param function: callable receiving a progress callback, see SegregWorker
+        :param done: callable receiving the value returned by function
+        """
+        self.setBusy(True)
+        self.thread = QThread()
+        self.worker = SegregWorker(function)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.dlg.progressBar.setValue)
+        self.worker.completed.connect(lambda result: self.taskCompleted(result, done))
+        self.worker.failed.connect(self.taskFailed)
+        self.worker.cancelled.connect(self.taskCancelled)
+        # quit from the worker thread, the GUI thread may be blocked waiting for it
+        self.worker.completed.connect(self.thread.quit, Qt.DirectConnection)
+        self.worker.failed.connect(self.thread.quit, Qt.DirectConnection)
+        self.worker.cancelled.connect(self.thread.quit, Qt.DirectConnection)
+        self.thread.finished.connect(self.taskFinished)
+        self.thread.start()
+
+    def cancelTask(self, wait=False):
+        """
+        Ask the running computation to stop.
+        :param wait: block until the worker thread is done, pending results
+            are then discarded
+        """
+        if self.worker is None:
+            return
+
+        self.worker.cancel()
+        if wait:
+            self.thread.quit()
+            self.thread.wait()
+            self.taskFinished()
+
+    def taskCompleted(self, result, done):
+        """Deliver the result of a computation unless it was discarded"""
+        if self.worker is not None:
+            done(result)
+
+    def taskFailed(self, message):
+        """Report an exception raised by a computation"""
+        if self.worker is None:
+            return
+        QgsMessageLog.logMessage(message, 'Segreg', QgsMessageLog.CRITICAL)
+        QMessageBox.critical(None, "Error", "Computation failed: %s" %
+                             message.strip().splitlines()[-1])
+
+    def taskCancelled(self):
+        """Inform a computation cancelled by the user"""
+        if self.worker is None:
+            return
+        self.iface.messageBar().pushMessage("Info", "Computation cancelled",
+                                            level=QgsMessageBar.INFO, duration=4)
+
+    def taskFinished(self):
+        """Release the worker thread and enable the buttons again"""
+        if self.worker is None:
+            return
+        self.worker = None
+        self.thread = None
+        self.setBusy(False)
+        self.showProfile()
+
+    def setBusy(self, busy):
+        """Enable the buttons according to a computation running or not"""
+        for button in [self.dlg.pbConfirm, self.dlg.pbRunIntensity, self.dlg.pbRunMeasures,
+                       self.dlg.pbOpenPath]:
+            button.setEnabled(not busy)
+        self.dlg.pbCancel.setEnabled(busy)
+        self.dlg.progressBar.setValue(0)
+
+    def problemSize(self):
+        """Size and parameters of the current problem, stored with the stage records"""
+        return self.core.problemSize()
+
+    def showProfile(self):
+        """Show the stages of the current run below the information tab text"""
+        # widgets are updated from the GUI thread once a computation is done
+        if self.worker is not None:
+            return
+        self.dlg.plainTextEdit.setPlainText(self.infoText + '\n\nLast run:\n' +
+                                            self.profile.summary())
+
+    def finishProfile(self):
+        """
+        End the current run: its stages are appended as a JSON line to the log
+        file if enabled on the dialog, at the Segreg/profileLog setting
+        (segreg_runs.jsonl in the QGIS settings folder by default).
+        """
+        if self.profile.stages and self.dlg.cbProfileLog.isChecked() is True:
+            default = os.path.join(QgsApplication.qgisSettingsDirPath(), 'segreg_runs.jsonl')
+            path = QSettings().value('Segreg/profileLog', default)
+            try:
+                self.profile.writeLog(path, date=datetime.datetime.now().isoformat(),
+                                      layer=self.confirmedLayerName)
+            except (IOError, OSError):
+                self.iface.messageBar().pushMessage("Warning", "Could not write run log",
+                                                    level=QgsMessageBar.WARNING, duration=4)
+        self.profile.clear()
+
+    def openCache(self):
+        """
+        Open the cache of centroids and weights if enabled on the dialog. Folder
+        and size in megabytes are read from the Segreg/cacheDir and
+        Segreg/cacheSize settings.
+        :return: SegregCache instance or None if disabled
+        """
+        if self.dlg.cbCache.isChecked() is False:
+            return None
+
+        settings = QSettings()
+        default = os.path.join(QgsApplication.qgisSettingsDirPath(), 'segreg_cache')
+        directory = settings.value('Segreg/cacheDir', default)
+        size = int(settings.value('Segreg/cacheSize', 2048))
+        return SegregCache(directory, size)
+
+    def readFeatures(self, layer, id_name, field_names, digest=None, centroids=True):
+        """
+        Read tract ids, group populations and polygon centroids in a single
+        pass over the features. Only the id and group fields are requested from
+        the provider and values are stored in arrays allocated from the feature
+        count. Null or invalid populations are read as zero.
+        :param layer: input QgsVectorLayer
+        :param id_name: name of the tract id field
+        :param field_names: list with the names of the group fields
+        :param digest: optional hashlib object updated with the geometries, used
+            as cache key
+        :param centroids: False to skip the centroids, known from cache
+        :return: tuple with the n x 1 tract ids, the n x 2 centroids (None if
+            skipped) and the n x m population
+        """
+        index = [layer.fieldNameIndex(name) for name in [id_name] + list(field_names)]
+        request = QgsFeatureRequest().setSubsetOfAttributes(index)
+        n_feature = max(layer.featureCount(), 0)
+        tract_id = [None] * n_feature
+        centroid = np.empty((n_feature, 2))
+        pop = np.empty((n_feature, len(field_names)))
+
+        count = 0
+        for feat in layer.getFeatures(request):
+            # feature count may be an estimate on some providers
+            if count == len(pop):
+                tract_id.extend([None] * (count + 1))
+                centroid = np.resize(centroid, (2 * count + 1, 2))
+                pop = np.resize(pop, (2 * count + 1, len(field_names)))
+
+            attributes = feat.attributes()
+            tract_id[count] = str(attributes[index[0]])
+            for column, field in enumerate(index[1:]):
+                try:
+                    pop[count, column] = float(attributes[field])
+                except (TypeError, ValueError):
+                    pop[count, column] = 0.0
+
+            geometry = feat.geometry()
+            if digest is not None:
+                digest.update(geometry.asWkb())
+            if centroids:
+                point = geometry.centroid().asPoint()
+                centroid[count] = point.x(), point.y()
+            count += 1
+
+        tract_id = np.asarray(tract_id[:count]).reshape((count, 1))
+        if centroids:
+            centroid = centroid[:count]
+        else:
+            centroid = None
+        return tract_id, centroid, pop[:count]
+
+    def readCentroids(self, layer):
+        """
+        Read the polygon centroids of a layer, no attribute being requested,
+        when the centroids skipped by readFeatures are not in cache after all.
+        :param layer: input QgsVectorLayer
+        :return: n x 2 array with x and y of the centroids
+        """
+        centroid = []
+        request = QgsFeatureRequest().setSubsetOfAttributes([])
+        for feat in layer.getFeatures(request):
+            point = feat.geometry().centroid().asPoint()
+            centroid.append((point.x(), point.y()))
+        return np.asarray(centroid, dtype=float).reshape((len(centroid), 2))
+
+    def scratchDirectory(self):
+        """
+        Directory of the memory-mapped arrays if out-of-core arrays are enabled
+        (self.outOfCore), created on first use under the Segreg/scratchDir
+        setting (system temporary folder by default) and removed by
+        clearVariables.
+        :return: directory path or None if disabled
+        """
+        if self.outOfCore is False:
+            return None
+
+        if self.scratchDir is None:
+            base = QSettings().value('Segreg/scratchDir', tempfile.gettempdir())
+            self.scratchDir = tempfile.mkdtemp(prefix='segreg_', dir=base)
+        return self.scratchDir
+
     def runIntensityButton(self):
         """Run population intensity for selected bandwidth and weight method"""
-        if not np.any(self.pop):
+        if not np.any(self.core.pop):
             QMessageBox.critical(None, "Error", 'No group selected!')
         else:
             # set fixed IDs for radioButtons according to weightmethod
@@ -362,18 +595,40 @@ class Segreg:
             self.dlg.bgWeight.setId(self.dlg.mvwind, 3)
 
             # set parameters to call locality matrix
+            self.readOptions()
             weight = self.dlg.bgWeight.checkedId()
-            bw = int(self.dlg.leBandwidht.text())
+            bw = [int(x) for x in self.dlg.leBandwidht.text().split(',') if x.strip()]
+            engine = ENGINES[self.dlg.cbEngine.currentIndex()]
+            workers = self.dlg.sbWorkers.value()
+            tolerance = None
+            if self.dlg.leTolerance.text():
+                tolerance = float(self.dlg.leTolerance.text())
 
             # check if weight method was selected
             if weight == -1:
                 QMessageBox.critical(None, "Error", "Please select a weight method")
+            elif tolerance is not None and not 0 < tolerance < 1:
+                QMessageBox.critical(None, "Error", "Tolerance must be between 0 and 1")
+            elif engine == 'fft' and regularLattice(self.core.location) is None:
+                msg = "Centroids are not a regular grid, please select another engine"
+                QMessageBox.critical(None, "Error", msg)
             else:
-                self.cal_localityMatrix(bw, weight)
-                self.iface.messageBar().pushMessage("Info",
-                 "Matrix of shape %s computed" % str(self.locality.shape),
-                                                level=QgsMessageBar.INFO,
-                                                duration=4)
+                def compute(progress):
+                    return self.cal_bandwidthSweep(bw, weight, engine, tolerance, workers,
+                                                   progress)
+                self.startTask(compute, self.intensityDone)
+
+    def intensityDone(self, result):
+        """Inform the intensity computed in background"""
+        if len(self.core.bandwidths) > 1:
+            msg = "Matrices of shape %s computed" % str(self.core.localitySweep.shape)
+        else:
+            msg = "Matrix of shape %s computed" % str(self.core.locality.shape)
+        if self.core.localityError > 0:
+            msg += ", max truncation error %g" % self.core.localityError
+        self.iface.messageBar().pushMessage("Info", msg,
+                                        level=QgsMessageBar.INFO,
+                                        duration=4)
 
     def getWeight(self, distance, bandwidth, weightmethod=1):
         """
@@ -383,191 +638,61 @@ class Segreg:
         :param weightmethod: method to be used: 1-gussian , 2-bi square and 3-moving window
         :return: weight value for internal use
         """
-        distance = np.asarray(distance.T)
-
-        if weightmethod == 1:
-            weight = np.exp((-0.5) * (distance / bandwidth) * (distance / bandwidth))
+        return kernelWeight(np.asarray(distance.T), bandwidth, weightmethod)
 
-        elif weightmethod == 2:
-            weight = (1 - (distance / bandwidth) * (distance / bandwidth)) * (
-            1 - (distance / bandwidth) * (distance / bandwidth))
-            sel = np.where(distance > bandwidth)
-            weight[sel[0]] = 0
-
-        elif weightmethod == 3:
-            weight = (1 + (distance * 0))
-            sel = np.where(distance > bandwidth)
-            weight[sel[0]] = 0
-
-        else:
-            raise Exception('Invalid weight method selected!')
-
-        return weight
-
-    def cal_localityMatrix(self, bandwidth, weightmethod):
+    def cal_localityMatrix(self, bandwidth, weightmethod, engine='auto', tolerance=None, workers=1,
+                           progress=None):
         """
-        Compute the local population intensity for all groups.
-        :param bandwidth: bandwidth for neighborhood in meters
-        :param weightmethod: 1 for gaussian, 2 for bi-square and empty for moving window
+        Compute the local population intensity for all groups, see
+        SegregEngine.localityMatrix.
         :return: 2d array like with population intensity for all groups
         """
-        n_local = self.location.shape[0]
-        n_subgroup = self.pop.shape[1]
-        locality_temp = np.empty([n_local, n_subgroup])
-
-        for index in range(0, n_local):
-            for index_sub in range(0, n_subgroup):
-                cost = cdist(self.location[index, :], self.location)
-                weight = self.getWeight(cost, bandwidth, weightmethod)
-                locality_temp[index, index_sub] = np.sum(weight * np.asarray(self.pop[:, index_sub]))/np.sum(weight)
+        self.cal_bandwidthSweep([bandwidth], weightmethod, engine, tolerance, workers, progress)
+        return self.core.locality
 
-        self.locality = locality_temp
-        # assign zero to negative values
-        self.locality[np.where(self.locality < 0)[0], np.where(self.locality < 0)[1]] = 0
-
-    def cal_localDissimilarity(self):
+    @profiled('intensity')
+    def cal_bandwidthSweep(self, bandwidths, weightmethod, engine='auto', tolerance=None,
+                           workers=1, progress=None):
         """
-        Compute local dissimilarity for all groups.
+        Compute the local population intensity for several bandwidths in one
+        pass, see SegregEngine.bandwidthSweep. Memory budget, precision and
+        scratch directory are the ones read by readOptions.
+        :return: 3d array like with population intensity by bandwidth
         """
-        # non-spatial version loop, uses raw data
-        if len(self.locality) == 0:
-            lj = np.ravel(self.pop_sum)
-            tjm = np.asarray(self.pop) * 1.0 / lj[:, None]
-            tm = np.sum(self.pop, axis=0) * 1.0 / np.sum(self.pop)
-            index_i = np.sum(np.asarray(tm) * np.asarray(1 - tm))
-            pop_total = np.sum(self.pop)
-            local_diss = np.sum(1.0 * np.array(np.fabs(tjm - tm)) *
-                                np.asarray(self.pop_sum).ravel()[:, None] / (2 * pop_total * index_i), axis=1)
+        return self.core.bandwidthSweep(bandwidths, weightmethod, engine, tolerance, workers,
+                                        progress)
 
-        # spatial version loop, uses population intensity
-        else:
-            lj = np.asarray(np.sum(self.locality, axis=1))
-            tjm = self.locality * 1.0 / lj[:, None]
-            tm = np.sum(self.pop, axis=0) * 1.0 / np.sum(self.pop)
-            index_i = np.sum(np.asarray(tm) * np.asarray(1 - tm))
-            pop_total = np.sum(self.pop)
-            local_diss = np.sum(1.0 * np.array(np.fabs(tjm - tm)) *
-                                np.asarray(self.pop_sum).ravel()[:, None] / (2 * pop_total * index_i), axis=1)
-
-        # clear nan values and transpose matrix
-        local_diss = np.nan_to_num(local_diss)
-        local_diss = np.asmatrix(local_diss).transpose()
-        self.local_dissimilarity = local_diss
+    def cal_localDissimilarity(self, progress=None):
+        """Compute local dissimilarity for all groups"""
+        self.core.computeMeasures(['local_dissimilarity'], progress)
 
     def cal_globalDissimilarity(self):
-        """
-        Compute global dissimilarity calling the local version and summing up.
-        """
-        local_diss = self.local_dissimilarity
-        self.global_dissimilarity = np.sum(local_diss)
+        """Compute global dissimilarity from the local version"""
+        self.core.computeMeasures(['global_dissimilarity'])
 
-    def cal_localExposure(self):
-        """
-        Compute the local exposure index of group m to group n.
-        in situations where m=n, then the result is the isolation index.
-        """
-        m = self.n_group
-        j = self.n_location
-        exposure_rs = np.zeros((j, (m * m)))
+    def cal_localExposure(self, progress=None):
+        """Compute the local exposure of the group pairs at self.core.exposurePairs"""
+        self.core.computeMeasures(['local_exposure'], progress)
 
-        # non-spatial version loop, uses raw data
-        if len(self.locality) == 0:
-            local_expo = np.asarray(self.pop) * 1.0 / np.asarray(np.sum(self.pop, axis=0)).ravel()
-            locality_rate = np.asarray(self.pop) * 1.0 / np.asarray(np.sum(self.pop, axis=1)).ravel()[:, None]
-            for i in range(m):
-                exposure_rs[:, ((i * m) + 0):((i * m) + m)] = np.asarray(locality_rate) * \
-                                                              np.asarray(local_expo[:, i]).ravel()[:, None]
-        # spatial version loop, uses population intensity
-        else:
-            local_expo = np.asarray(self.pop) * 1.0 / np.asarray(np.sum(self.pop, axis=0)).ravel()
-            locality_rate = np.asarray(self.locality) * 1.0 / np.asarray(np.sum(self.locality, axis=1)).ravel()[:, None]
-            for i in range(m):
-                exposure_rs[:, ((i * m) + 0):((i * m) + m)] = np.asarray(locality_rate) * \
-                                                              np.asarray(local_expo[:, i]).ravel()[:, None]
+    def cal_globalExposure(self, progress=None):
+        """Compute global exposure of all the group pairs"""
+        self.core.computeMeasures(['global_exposure'], progress)
 
-        # clear nan and inf values and convert to matrix
-        exposure_rs[np.isinf(exposure_rs)] = 0
-        exposure_rs[np.isnan(exposure_rs)] = 0
-        exposure_rs = np.asmatrix(exposure_rs)
-        self.local_exposure = exposure_rs
-
-    def cal_globalExposure(self):
-        """
-        Compute global exposure calling the local version and summing up.
-        """
-        m = self.n_group
-        local_exp = self.local_exposure
-        global_exp = np.sum(local_exp, axis=0)
-        global_exp = global_exp.reshape((m, m))
-        self.global_exposure = global_exp
-
-    def cal_localEntropy(self):
-        """
-        Compute local entropy score for a unit area Ei (diversity). A unit
-        within the metropolitan area, such as a census tract. If population
-        intensity was previously computed, the spatial version will be returned,
-        otherwise the non spatial version will be selected (raw data).
-        """
-        # non-spatial version, uses raw data
-        if len(self.locality) == 0:
-            proportion = np.asarray(self.pop / self.pop_sum)
-
-        # spatial version, uses population intensity
-        else:
-            polygon_sum = np.sum(self.locality, axis=1).reshape(self.n_location, 1)
-            proportion = np.asarray(self.locality / polygon_sum)
-
-        entropy = proportion * np.log(1 / proportion)
-
-        # clear nan and inf values, sum line and reshape
-        entropy[np.isnan(entropy)] = 0
-        entropy[np.isinf(entropy)] = 0
-        entropy = np.sum(entropy, axis=1)
-        entropy = entropy.reshape((self.n_location, 1))
-        self.local_entropy = entropy
+    def cal_localEntropy(self, progress=None):
+        """Compute local entropy, spatial if the intensity was computed"""
+        self.core.computeMeasures(['local_entropy'], progress)
 
     def cal_globalEntropy(self):
-        """
-        Compute the global entropy score E (diversity), metropolitan area's entropy score.
-        """
-        group_score = []
-        pop_total = np.sum(self.pop_sum)
-        prop = np.asarray(np.sum(self.pop, axis=0))[0]
-
-        # loop at sum of each population groups
-        for group in prop:
-            group_idx = group / pop_total * np.log(1 / (group / pop_total))
-            group_score.append(group_idx)
-
-        # sum scores from each group to get the result
-        global_entro = np.sum(group_score)
-        self.global_entropy = global_entro
+        """Compute the global entropy score E (diversity)"""
+        self.core.computeMeasures(['global_entropy'])
 
     def cal_localIndexH(self):
-        """
-        Computes the local entropy index H for all localities. The functions
-        cal_localEntropy() for local diversity and cal_globalEntropy for global
-        entropy are called as input. If population intensity was previously
-        computed, the spatial version will be returned, else the non spatial
-        version will be selected (raw data).
-        """
-        local_entropy = self.local_entropy
-        global_entropy = self.global_entropy
-
-        # compute index
-        et = np.asarray(global_entropy * np.sum(self.pop_sum))
-        eei = np.asarray(global_entropy - local_entropy)
-        h_local = np.asarray(self.pop_sum) * eei / et
-
-        self.local_indexh = h_local
+        """Compute the local entropy index H for all localities"""
+        self.core.computeMeasures(['local_indexh'])
 
     def cal_globalIndexH(self):
-        """
-        Compute global index H calling the local version summing up.
-        """
-        h_local = self.local_indexh
-        h_global = np.sum(h_local, axis=0)
-        self.global_indexh = h_global
+        """Compute global index H from the local version"""
+        self.core.computeMeasures(['global_indexh'])
 
     def selectAllMeasures(self):
         """Select all check boxes on measures groups"""
@@ -579,174 +704,236 @@ class Segreg:
 
     def runMeasuresButton(self):
         """
-        Call the functions to compute local and global measures. The dependency
-        complexity is handle by chacking the flaged measures and calling local
-        measures for global versions. Results are stored for posterior output save.
-        """
-        # call local and global exposure/isolation measures
-        if self.dlg.expo_global.isChecked() is True:
-            self.cal_localExposure()
-            self.cal_globalExposure()
-        if self.dlg.expo_local.isChecked() is True and len(self.local_exposure) == 0:
-            self.cal_localExposure()
-
-        # call local and global dissimilarity measures
-        if self.dlg.diss_global.isChecked() is True:
-            self.cal_localDissimilarity()
-            self.cal_globalDissimilarity()
-        if self.dlg.diss_local.isChecked() is True and len(self.local_dissimilarity) == 0:
-            self.cal_localDissimilarity()
-
-        # call local and global entropy measures
-        if self.dlg.entro_global.isChecked() is True:
-            self.cal_localEntropy()
-            self.cal_globalEntropy()
-        if self.dlg.entro_local.isChecked() is True and len(self.local_entropy) == 0:
-            self.cal_localEntropy()
-
-        # call local and global index H measures
-        if self.dlg.idxh_global.isChecked() is True:
-            self.cal_localEntropy()
-            self.cal_globalEntropy()
-            self.cal_localIndexH()
-            self.cal_globalIndexH()
-        if self.dlg.idxh_local.isChecked() is True and len(self.local_indexh) == 0:
-            self.cal_localEntropy()
-            self.cal_globalEntropy()
-            self.cal_localIndexH()
+        Compute the measures flagged for the intensity computed, one set of
+        measures for each bandwidth if a bandwidth sweep was run.
+        """
+        self.readOptions()
+        try:
+            self.core.exposurePairs = self.readExposurePairs()
+        except ValueError:
+            msg = "Exposure pairs must be groups i-j separated by commas, as 0-1, 1-1"
+            QMessageBox.critical(None, "Error", msg)
+            return
 
+        def compute(progress):
+            if len(self.core.bandwidths) > 1:
+                return self.cal_sweepMeasures(progress)
+            return self.computeMeasures(progress)
+        self.startTask(compute, self.measuresDone)
+
+    def readExposurePairs(self):
+        """
+        Group pairs of the local exposure typed on the measures tab, as i-j
+        separated by commas, for example 0-1, 1-0, 2-2.
+        :return: list of (i, j) tuples, None for all the pairs
+        """
+        text = self.dlg.leExposurePairs.text().strip()
+        if not text:
+            return None
+
+        pairs = []
+        for item in text.split(','):
+            i, j = [int(group) for group in item.split('-')]
+            if not (0 <= i < self.core.n_group and 0 <= j < self.core.n_group):
+                raise ValueError('Group out of range: %s' % item)
+            if (i, j) not in pairs:
+                pairs.append((i, j))
+        return pairs
+
+    def measuresDone(self, result):
+        """Inform the measures computed in background"""
         # inform sucess if all were computed
         QMessageBox.information(None, "Info", 'Measures computed successfully!')
 
+    def flaggedMeasures(self):
+        """Names of the measures flagged at self.measureFlags, see readOptions"""
+        return [MEASURE_FLAGS[name] for name in sorted(self.measureFlags)
+                if self.measureFlags[name] is True]
+
+    @profiled('measures')
+    def computeMeasures(self, progress=None):
+        """
+        Compute the flagged measures and the ones they depend on, each one once,
+        see SegregEngine.computeMeasures. Local measures share a single pass
+        over the rows and their intermediate terms.
+        :param progress: optional callable receiving the work done and the total
+        """
+        self.core.computeMeasures(self.flaggedMeasures(), progress)
+
+    @profiled('measures')
+    def cal_sweepMeasures(self, progress=None):
+        """
+        Compute the flagged measures for each bandwidth of the intensity sweep,
+        see SegregEngine.sweepMeasures.
+        :param progress: optional callable receiving the work done and the total
+        :return: list of dictionaries with bandwidth, intensity and measures
+        """
+        return self.core.sweepMeasures(self.flaggedMeasures(), progress)
+
     def joinResultsData(self):
-        """ Join results on a unique matrix and assign names for columns to be
-        used as header for csv file and shapefile output"""
-        names = ['id','x','y']
-        measures_computed = []
-
-        # create new names for groups starting by 0
-        for i in range(self.n_group):
-            names.append('group_' + str(i))
-
-        # update names with locality if computed
-        if len(self.locality) != 0:
-            measures_computed.append('self.locality')
-            for i in range(self.n_group):
-                names.append('intens_' + str(i))
-
-        # update names with exposure/isolation if computed
-        if self.dlg.expo_local.isChecked() is True:
-            measures_computed.append('self.local_exposure')
-            for i in range(self.n_group):
-                for j in range(self.n_group):
-                    if i == j:
-                        names.append('iso_' + str(i) + str(j))
-                    else:
-                        names.append('exp_' + str(i) + str(j))
-
-        # update names with dissimilarity if computed
-        if self.dlg.diss_local.isChecked() is True:
-            measures_computed.append('self.local_dissimilarity')
-            names.append('dissimil')
-
-        # update names with entropy if computed
-        if self.dlg.entro_local.isChecked() is True:
-            measures_computed.append('self.local_entropy')
-            names.append('entropy')
-
-        # update names with index H if computed
-        if self.dlg.idxh_local.isChecked() is True:
-            measures_computed.append('self.local_indexh')
-            names.append('indexh')
-
-        output_labels = tuple([eval(x) for x in measures_computed])
-
-        # try to concaneta results, else only original input
+        """ Join results on a typed column table and assign names for columns
+        to be used as header for csv file and shapefile output"""
+        flags = [('expo_local', 'local_exposure'), ('diss_local', 'local_dissimilarity'),
+                 ('entro_local', 'local_entropy'), ('idxh_local', 'local_indexh')]
+        measures = [measure for button, measure in flags
+                    if getattr(self.dlg, button).isChecked() is True]
         try:
-            computed_results = np.concatenate(output_labels, axis=1)
-            results_matrix = np.concatenate((self.tract_id, self.attributeMatrix, computed_results), axis=1)
-            measures_computed[:] = []
-            return results_matrix, names
-        except ValueError:
-            results_matrix = np.concatenate((self.tract_id, self.attributeMatrix), axis=1)
-            return results_matrix, names
-        except:
+            return self.core.results(measures)
+        except Exception:
             QMessageBox.critical(None, "Error", 'Could not join result data!')
             raise
 
+    @profiled('addShapeToCanvas')
     def addShapeToCanvas(self, result, path):
         """Add results to Canvas as a new shapefile based on original input"""
+        newLayer = self.resultLayer(result, QFileInfo(path).baseName())
+
+        # add new layer to canvas
+        QgsMapLayerRegistry.instance().addMapLayer(newLayer)
+
+    def resultLayer(self, result, name):
+        """
+        Memory layer with the geometries and attributes of the original input
+        and the local results. The features are created with the source
+        attributes followed by the results of their tract, matched by tract id,
+        and added in one call.
+        :param result: ResultTable from joinResults
+        :param name: layer name
+        :return: QgsVectorLayer
+        """
         # get data from layer confirmed on groups selection
         sourceLayer = QgsMapLayerRegistry.instance().mapLayersByName(self.confirmedLayerName)[0]
-        sourceFeats = [feat for feat in sourceLayer.getFeatures()]
         sourceGeometryType = ['Point','Line','Polygon'][sourceLayer.geometryType()]
         sourceCRS = sourceLayer.crs().authid()
 
         # data from results for the new layer
-        name = QFileInfo(path).baseName()
-        data = result[0][:, (3 + self.n_group):]
-        labels = result[1][(3 + self.n_group):]
+        labels = result.names[(2 + self.core.n_group):]
+        data = result.block(names=labels)
+
+        # result rows by tract id, feature order is used if ids are not unique
+        tract_id = result.ids.astype(str).tolist()
+        rows = dict((tract, row) for row, tract in enumerate(tract_id))
+        if len(rows) != len(tract_id):
+            rows = None
+        idField = sourceLayer.fieldNameIndex(self.confirmedIdName)
 
         # create new layer copying data from source and extend fields
         newLayer = QgsVectorLayer(sourceGeometryType + '?crs='+sourceCRS, name, "memory")
         provider = newLayer.dataProvider()
         attr = sourceLayer.dataProvider().fields().toList()
         attr.extend([QgsField(label, QVariant.Double) for label in labels])
-        provider.addFeatures(sourceFeats)
         provider.addAttributes(attr)
         newLayer.updateFields()
 
-        # add results from measures selected for calculation
-        for idxfeat, feat in enumerate(newLayer.getFeatures()):
-            featid = int(feat.id())
-            for idxlabel, label in enumerate(labels):
-                idxfield = int(provider.fieldNameMap()[label])
-                val = float(data[idxfeat, idxlabel])
-                provider.changeAttributeValues({featid : {idxfield : val}})
+        # add features with the results from measures selected for calculation
+        missing = [None] * len(labels)
+        features = []
+        for index, feat in enumerate(sourceLayer.getFeatures()):
+            attributes = feat.attributes()
+            if rows is None:
+                row = index
+            else:
+                row = rows.get(str(attributes[idField]))
+            feature = QgsFeature()
+            feature.setGeometry(feat.geometry())
+            if row is None or row >= len(data):
+                feature.setAttributes(attributes + missing)
+            else:
+                feature.setAttributes(attributes + data[row].tolist())
+            features.append(feature)
+        provider.addFeatures(features)
+        newLayer.updateExtents()
+        return newLayer
 
-        # add new layer to canvas
-        QgsMapLayerRegistry.instance().addMapLayer(newLayer)
+    def writeGeoPackage(self, result, path):
+        """
+        Save the original input with local results as a GeoPackage layer.
+        :param result: ResultTable from joinResults
+        :param path: output file name
+        """
+        layer = self.resultLayer(result, QFileInfo(path).baseName())
+        error = QgsVectorFileWriter.writeAsVectorFormat(layer, path, 'utf-8', layer.crs(), 'GPKG')
+        if error != QgsVectorFileWriter.NoError:
+            raise Exception('Could not write GeoPackage!')
 
     def saveResults(self):
-        """ Save results to a local file."""
+        """
+        Save results to a local file, one for each bandwidth of a sweep. The
+        format is the one of the filter selected on the save dialog.
+        """
         try:
-            filename = QFileDialog.getSaveFileName(self.dlg, "Select output file ", "", "*.csv")
+            formats = outputFormats()
+            filters = ['%s (*.%s)' % (label, extension) for extension, label in formats]
+            filename, selected = QFileDialog.getSaveFileNameAndFilter(
+                self.dlg, "Select output file ", "", ';;'.join(filters))
+            if not filename:
+                return
+
+            # add the extension of the selected format if missing
+            extension = formats[filters.index(selected)][0] if selected in filters else 'csv'
+            if outputFormat(filename) != extension:
+                filename += '.' + extension
             self.dlg.leOutput.setText(filename)
             path = self.dlg.leOutput.text()
-            result = self.joinResultsData()
-            labels = str(', '.join(result[1]))
-
-            # save local measures results on a csv file
-            np.savetxt(path, result[0], header=labels, delimiter=',', newline='\n', fmt="%s")
 
-            # add result to canvas as shapefile if requested
-            if self.dlg.addToCanvas.isChecked() is True:
-                try:
-                    self.addShapeToCanvas(result, path)
-                except:
-                    QMessageBox.critical(None, "Error", "Could not create shape!")
-                    return
-
-            # save global results to a second csv file
-            with open("%s_global.csv" % path, "w") as f:
-                f.write('Global dissimilarity: ' + str(self.global_dissimilarity))
-                f.write('\nGlobal entropy: ' + str(self.global_entropy))
-                f.write('\nGlobal Index H: ' + str(self.global_indexh))
-                f.write('\nGlobal isolation/exposure: \n')
-                f.write(str(self.global_exposure))
+            if len(self.core.sweepResults) > 1:
+                root = path[:-len(extension) - 1]
+                for index, sweep in enumerate(self.core.sweepResults):
+                    self.core.loadSweepResult(index)
+                    self.writeResults("%s_bw%s.%s" % (root, sweep['bandwidth'], extension))
+            else:
+                self.writeResults(path)
 
             # clear local variables after save
-            self.local_dissimilarity = []
-            self.local_exposure = []
-            self.local_entropy = []
-            self.local_indexh = []
-        except:
+            self.core.local_dissimilarity = []
+            self.core.local_exposure = []
+            self.core.local_entropy = []
+            self.core.local_indexh = []
+
+            # the run ends with its output
+            self.showProfile()
+            self.finishProfile()
+        except Exception:
             QMessageBox.critical(None, "Error", "Could not save data!")
             return
 
+    def writeResults(self, path):
+        """
+        Write local results on the format given by the file extension, global
+        results to a csv file and local results to canvas if requested.
+        """
+        result = self.joinResultsData()
+        extension = outputFormat(path)
+
+        # save local measures results on the selected format
+        with self.profile.stage('writeOutput', format=extension, **self.problemSize()):
+            if extension == 'gpkg':
+                self.writeGeoPackage(result, path)
+            else:
+                decimals = self.dlg.sbDecimals.value()
+                writeTable(path, result, decimals if decimals >= 0 else None)
+
+        # add result to canvas as shapefile if requested
+        if self.dlg.addToCanvas.isChecked() is True:
+            try:
+                self.addShapeToCanvas(result, path)
+            except Exception:
+                QMessageBox.critical(None, "Error", "Could not create shape!")
+                return
+
+        # save global results to a second csv file
+        writeGlobal("%s_global.csv" % path, self.core.global_dissimilarity,
+                    self.core.global_entropy, self.core.global_indexh, self.core.global_exposure)
+
     def run(self):
         """Run method to call dialog and connect interface with functions"""
 
+        # bring back the dialog of a computation still running
+        if self.worker is not None:
+            self.dlg.show()
+            self.dlg.raise_()
+            return
+
         # pin view on first tab for attributes selection
         self.dlg.tabWidget.setCurrentIndex(0)
 
@@ -756,18 +943,10 @@ class Segreg:
         # populate layers list using a projected CRS
         self.addLayers()
 
-        # show the dialog
+        # show the dialog, modeless so QGIS is usable while computations run
         self.dlg.show()
 
         # clear if there is any layer and warn user if not
         if self.dlg.cbLayers.count() == 0:
             QMessageBox.critical(None, "Error", 'No layer found!')
             return
-
-        # Run the dialog event loop
-        result = self.dlg.exec_()
-
-        # See if OK was pressed
-        if result:
-            # exit
-            pass
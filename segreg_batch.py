@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Batch runs of the measures over many inputs, without QGIS, for example:
+
+     python segreg_batch.py manifest.csv -o results --bandwidth 500 1000
+         --kernel gaussian --processes 8
+
+ The manifest lists one input by row, see readManifest. Jobs are spread over
+ a process pool, the local and global results of each job are written to the
+ output folder with a summary table of all the jobs.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+from timeit import default_timer
+
+import numpy as np
+
+try:
+    from osgeo import ogr
+except ImportError:  # vector inputs need the GDAL bindings shipped with QGIS
+    ogr = None
+
+from segreg_engine import WEIGHT_METHODS, SegregEngine, SegregPanel
+from segreg_intensity import ENGINES, PRECISIONS
+from segreg_measures import MEASURES
+from segreg_output import outputFormats
+
+# manifest columns, every other column is ignored
+MANIFEST_FIELDS = ['path', 'name', 'layer', 'id', 'x', 'y', 'groups', 'year']
+
+# summary table columns, global exposure is kept in the global result files
+SUMMARY_FIELDS = ['name', 'year', 'path', 'status', 'n', 'groups', 'bandwidth', 'seconds',
+                  'global_dissimilarity', 'global_entropy', 'global_indexh', 'output', 'error']
+
+
+def readManifest(path):
+    """
+    Read the jobs of a batch from a CSV or JSON manifest. Each job has the
+    input path and optionally:
+      name: output name, the input file name by default
+      layer: layer of a GeoPackage, the first one by default
+      id: tract id field, the row number by default
+      x, y: coordinate columns of a CSV input, x and y by default
+      groups: group fields separated by semicolons, the --groups option by default
+      year: census year of the groups. Rows of the same name with a year are
+        one panel job on a single input, see SegregPanel, with the years at
+        'years' and their groups at 'year_groups'
+    Relative paths are read from the manifest folder.
+    :param path: .csv file with a header row or .json file with a list of objects
+    :return: list of dictionaries, one by job
+    """
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            jobs = json.load(f)
+    else:
+        with open(path) as f:
+            jobs = list(csv.DictReader(f))
+
+    folder = os.path.dirname(os.path.abspath(path))
+    manifest = []
+    for row, job in enumerate(jobs):
+        job = dict((key, value) for key, value in job.items()
+                   if key in MANIFEST_FIELDS and value not in (None, ''))
+        if 'path' not in job:
+            raise Exception('Manifest row %d has no path!' % (row + 1))
+        job['path'] = os.path.join(folder, job['path'])
+        if 'name' not in job:
+            job['name'] = os.path.splitext(os.path.basename(job['path']))[0]
+        if 'groups' in job and not isinstance(job['groups'], list):
+            job['groups'] = [name.strip() for name in job['groups'].split(';') if name.strip()]
+        manifest.append(job)
+
+    # years of a panel are gathered on the job of their first row
+    panels = {}
+    for job in list(manifest):
+        if 'year' not in job:
+            continue
+        panel = panels.get(job['name'])
+        if panel is None:
+            panel = panels[job['name']] = job
+            panel['years'], panel['year_groups'] = [], []
+        elif panel['path'] != job['path']:
+            raise Exception('Years of %s must be read from the same input!' % job['name'])
+        else:
+            manifest.remove(job)
+        panel['years'].append(job.pop('year'))
+        panel['year_groups'].append(job.pop('groups', None))
+
+    names = [job['name'] for job in manifest]
+    if len(set(names)) != len(names):
+        raise Exception('Manifest names must be unique!')
+    return manifest
+
+
+def readTable(path, groups, id_name=None, x_name='x', y_name='y'):
+    """
+    Read tracts from a CSV file with coordinates and group columns. Empty or
+    invalid populations are read as zero, as on the plugin.
+    :param path: CSV file with a header row
+    :param groups: list with the names of the group columns
+    :param id_name: tract id column, None to number the tracts from 0
+    :return: tuple with the n tract ids (None without id column), the n x 2
+        coordinates and the n x m population
+    """
+    with open(path) as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader)]
+        names = [x_name, y_name] + list(groups)
+        if id_name is not None:
+            names.append(id_name)
+        missing = [name for name in names if name not in header]
+        if missing:
+            raise Exception('Columns not found: %s!' % ', '.join(missing))
+
+        index = [header.index(name) for name in groups]
+        x_index, y_index = header.index(x_name), header.index(y_name)
+        id_index = header.index(id_name) if id_name is not None else None
+        tract_id, location, pop = [], [], []
+        for line in reader:
+            if not line:
+                continue
+            location.append((float(line[x_index]), float(line[y_index])))
+            values = []
+            for column in index:
+                try:
+                    values.append(float(line[column]))
+                except ValueError:
+                    values.append(0.0)
+            pop.append(values)
+            if id_index is not None:
+                tract_id.append(line[id_index])
+
+    location = np.asarray(location, dtype=float).reshape((len(location), 2))
+    pop = np.asarray(pop, dtype=float).reshape((len(pop), len(groups)))
+    return tract_id or None, location, pop
+
+
+def readVector(path, groups, id_name=None, layer_name=None):
+    """
+    Read tracts from a GeoPackage, shapefile or any vector format of GDAL,
+    as polygon centroids. Coordinates must be projected, as on the plugin.
+    :param path: vector file name
+    :param groups: list with the names of the group fields
+    :param id_name: tract id field, None to number the tracts from 0
+    :param layer_name: layer of the file, None for the first one
+    :return: tuple with the n tract ids (None without id field), the n x 2
+        centroids and the n x m population
+    """
+    if ogr is None:
+        raise Exception('Vector inputs need the GDAL python bindings!')
+
+    source = ogr.Open(path)
+    if source is None:
+        raise Exception('Could not open %s!' % path)
+    layer = source.GetLayer(0) if layer_name is None else source.GetLayerByName(layer_name)
+    if layer is None:
+        raise Exception('Layer %s not found!' % layer_name)
+    reference = layer.GetSpatialRef()
+    if reference is not None and reference.IsGeographic():
+        raise Exception('Layer has geographic coordinates, a projected CRS is needed!')
+
+    definition = layer.GetLayerDefn()
+    fields = [definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())]
+    missing = [name for name in list(groups) + [id_name]
+               if name is not None and name not in fields]
+    if missing:
+        raise Exception('Fields not found: %s!' % ', '.join(missing))
+
+    tract_id, location, pop = [], [], []
+    for feature in layer:
+        centroid = feature.GetGeometryRef().Centroid()
+        location.append((centroid.GetX(), centroid.GetY()))
+        values = []
+        for name in groups:
+            value = feature.GetField(name)
+            try:
+                values.append(float(value))
+            except (TypeError, ValueError):
+                values.append(0.0)
+        pop.append(values)
+        if id_name is not None:
+            tract_id.append(str(feature.GetField(id_name)))
+
+    location = np.asarray(location, dtype=float).reshape((len(location), 2))
+    pop = np.asarray(pop, dtype=float).reshape((len(pop), len(groups)))
+    return tract_id or None, location, pop
+
+
+def readInput(job):
+    """
+    Read the tracts of a job, CSV files as tables and other files as vector layers.
+    :param job: dictionary from readManifest, with groups
+    :return: tuple with tract ids, coordinates and population
+    """
+    if not job.get('groups'):
+        raise Exception('No group fields for %s!' % job['name'])
+    if job['path'].lower().endswith('.csv'):
+        return readTable(job['path'], job['groups'], job.get('id'), job.get('x', 'x'),
+                         job.get('y', 'y'))
+    return readVector(job['path'], job['groups'], job.get('id'), job.get('layer'))
+
+
+def runJob(job):
+    """
+    Compute the measures of one input and write its results, run on a worker
+    process. Errors are reported on the records instead of stopping the batch.
+    :param job: dictionary from readManifest, with the options at job['options']
+    :return: list of summary records, one by bandwidth
+    """
+    options = job['options']
+    record = {'name': job['name'], 'path': job['path'], 'status': 'ok'}
+    start = default_timer()
+    try:
+        tract_id, location, pop = readInput(job)
+        if 'years' in job:
+            # groups of each year are consecutive columns of the input read
+            engine = SegregPanel(options['memory'], options['precision'])
+            split = np.cumsum([len(groups) for groups in job['year_groups']])[:-1]
+            engine.setInput(tract_id, location, np.split(pop, split, axis=1), job['years'])
+            engine.core.exposurePairs = options['pairs']
+            parts = list(zip(job['years'], engine.engines))
+        else:
+            engine = SegregEngine(options['memory'], options['precision'])
+            engine.setInput(tract_id, location, pop)
+            engine.exposurePairs = options['pairs']
+            parts = [(None, engine)]
+        record.update(n=len(location), groups=parts[0][1].n_group)
+
+        if options['bandwidths']:
+            engine.bandwidthSweep(options['bandwidths'], options['weightmethod'],
+                                  options['engine'], options['tolerance'])
+        if options['bandwidths'] and 'years' not in job:
+            engine.sweepMeasures(options['measures'])
+        else:
+            engine.computeMeasures(options['measures'])
+
+        path = os.path.join(options['output'], '%s.%s' % (job['name'], options['format']))
+        outputs = engine.writeResults(path, options['decimals'])
+        record['seconds'] = default_timer() - start
+
+        # one record by bandwidth and year with its global measures
+        records = []
+        for index, output in enumerate(outputs):
+            for year, part in parts:
+                result = dict((name, getattr(part, name)) for name in MEASURES)
+                if part.sweepResults:
+                    result = part.sweepResults[index]
+                summary = dict(record, year=year, bandwidth=result.get('bandwidth'),
+                               output=output)
+                for name in ('global_dissimilarity', 'global_entropy', 'global_indexh'):
+                    if len(np.atleast_1d(result[name])) == 1:
+                        summary[name] = float(np.ravel(result[name])[0])
+                records.append(summary)
+        return records
+    except Exception:
+        record.update(status='failed', seconds=default_timer() - start,
+                      error=traceback.format_exc().strip().splitlines()[-1])
+        return [record]
+
+
+def runBatch(manifest, options, processes=None):
+    """
+    Run the jobs of a manifest over a process pool, a line being written to
+    the standard error as each job finishes.
+    :param manifest: list of jobs from readManifest
+    :param options: dictionary with the options of every job, see jobOptions
+    :param processes: number of processes, all the cores if None, 1 to run
+        the jobs on this process
+    :return: list of summary records in manifest order
+    """
+    jobs = []
+    for job in manifest:
+        job = dict(job, options=options)
+        if 'years' in job:
+            job['year_groups'] = [groups or options['groups'] or []
+                                  for groups in job['year_groups']]
+            job['groups'] = [name for groups in job['year_groups'] for name in groups]
+        elif not job.get('groups'):
+            job['groups'] = options['groups']
+        jobs.append(job)
+
+    pool = None
+    if processes == 1 or len(jobs) < 2:
+        results = map(runJob, jobs)
+    else:
+        pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(jobs)))
+        results = pool.imap(runJob, jobs)
+
+    summary = []
+    try:
+        for index, records in enumerate(results):
+            sys.stderr.write('%d/%d %s %s\n' % (index + 1, len(jobs), records[0]['name'],
+                                                records[0]['status']))
+            summary.extend(records)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return summary
+
+
+def writeSummary(path, summary):
+    """
+    Save the summary records as a CSV table, one row by job and bandwidth.
+    :param path: output file name
+    :param summary: list of records from runBatch
+    """
+    with open(path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(SUMMARY_FIELDS)
+        for record in summary:
+            writer.writerow(['' if record.get(name) is None else record[name]
+                             for name in SUMMARY_FIELDS])
+
+
+def parsePairs(text):
+    """
+    Group pairs of the local exposure as i-j separated by commas.
+    :return: list of (i, j) tuples, None for all the pairs
+    """
+    if not text:
+        return None
+    return [tuple(int(group) for group in item.split('-')) for item in text.split(',')]
+
+
+def jobOptions(options):
+    """
+    Options shared by the jobs, as a dictionary sent to the worker processes.
+    :param options: parsed command line options
+    """
+    return {'output': os.path.abspath(options.output),
+            'groups': options.groups,
+            'measures': options.measures,
+            'bandwidths': options.bandwidth,
+            'weightmethod': WEIGHT_METHODS[options.kernel],
+            'engine': options.engine,
+            'tolerance': options.tolerance,
+            'precision': options.precision,
+            'memory': options.memory,
+            'pairs': options.pairs,
+            'format': options.format,
+            'decimals': options.decimals}
+
+
+def parseArguments(argv=None):
+    """Command line options"""
+    parser = argparse.ArgumentParser(description='Compute the Segreg measures for every input '
+                                                 'of a manifest.')
+    parser.add_argument('manifest', help='CSV or JSON file with one input by row, columns path, '
+                                         'name, layer, id, x, y and groups')
+    parser.add_argument('-o', '--output', default='.', help='folder of the results')
+    parser.add_argument('--groups', nargs='+', default=None,
+                        help='group fields of the inputs without groups on the manifest')
+    parser.add_argument('--measures', nargs='+', choices=MEASURES, default=MEASURES)
+    parser.add_argument('--bandwidth', type=int, nargs='+', default=[],
+                        help='bandwidths in meters, non spatial measures if empty')
+    parser.add_argument('--kernel', choices=sorted(WEIGHT_METHODS), default='gaussian')
+    parser.add_argument('--engine', choices=ENGINES, default='auto')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='relative weight tolerance to truncate the gaussian')
+    parser.add_argument('--precision', choices=PRECISIONS, default='float64')
+    parser.add_argument('--memory', type=int, default=1024,
+                        help='memory budget of each process in megabytes')
+    parser.add_argument('--pairs', type=parsePairs, default=None,
+                        help='group pairs of the local exposure as i-j separated by commas')
+    parser.add_argument('--format', choices=[extension for extension, label in outputFormats()
+                                             if extension != 'gpkg'],
+                        default='csv', help='output format of the local results')
+    parser.add_argument('--decimals', type=int, default=None,
+                        help='fixed decimals of csv values, exact values if empty')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='jobs run at the same time, all the cores if empty')
+    parser.add_argument('--summary', default=None,
+                        help='summary table, summary.csv on the output folder if empty')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parseArguments(argv)
+    manifest = readManifest(options.manifest)
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    summary = runBatch(manifest, jobOptions(options), options.processes)
+    path = options.summary or os.path.join(options.output, 'summary.csv')
+    writeSummary(path, summary)
+
+    failed = [record for record in summary if record['status'] != 'ok']
+    if failed:
+        sys.stderr.write('%d of %d jobs failed, see %s\n' % (len(failed), len(manifest), path))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
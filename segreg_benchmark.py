@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Headless benchmark of the intensity, measures and output stages on
+ synthetic tract layouts. Runs without QGIS, for example:
+
+     python segreg_benchmark.py --n 1000 10000 --layout uniform clustered grid
+         --kernel gaussian bisquare --engine auto dense -o benchmark.json
+
+ Every combination of the options is run and the wall time and peak memory
+ of each stage are written as JSON.
+"""
+import argparse
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import scipy
+
+from segreg_engine import WEIGHT_METHODS
+from segreg_intensity import ENGINES, PRECISIONS, localityMatrix
+from segreg_measures import (globalDissimilarity, globalEntropy, globalExposure, globalIndexH,
+                             localDissimilarity, localEntropy, localExposure, localIndexH)
+from segreg_output import arrowModule, joinResults, outputFormats, writeGlobal, writeTable
+from segreg_profile import StageProfile
+
+# synthetic layouts by name
+LAYOUTS = ['uniform', 'clustered', 'grid']
+
+# mean distance between neighbouring tracts in meters
+SPACING = 250.0
+
+
+def uniformLayout(n_location, n_group, rng):
+    """
+    Tracts spread uniformly over a square with SPACING meters between
+    neighbours, group shares drawn independently on each tract.
+    :param n_location: number of tracts
+    :param n_group: number of groups
+    :param rng: numpy RandomState
+    :return: tuple with the n x 2 coordinates and the n x m population
+    """
+    side = np.sqrt(n_location) * SPACING
+    location = rng.uniform(0, side, (n_location, 2))
+    share = rng.dirichlet(np.ones(n_group), n_location)
+    pop = rng.poisson(500 * share).astype(float)
+    return location, pop
+
+
+def clusteredLayout(n_location, n_group, rng):
+    """
+    Tracts gathered around one centre by 500 tracts, each cluster dominated
+    by one group so the layout is segregated.
+    :return: tuple with the n x 2 coordinates and the n x m population
+    """
+    side = np.sqrt(n_location) * SPACING
+    n_cluster = max(1, n_location // 500)
+    centre = rng.uniform(0, side, (n_cluster, 2))
+    cluster = rng.randint(0, n_cluster, n_location)
+    spread = side / (4 * np.sqrt(n_cluster))
+    location = centre[cluster] + rng.normal(0, spread, (n_location, 2))
+
+    weight = np.ones((n_cluster, n_group))
+    weight[np.arange(n_cluster), np.arange(n_cluster) % n_group] = 4 * n_group
+    share = np.array([rng.dirichlet(weight[c]) for c in cluster])
+    pop = rng.poisson(500 * share).astype(float)
+    return location, pop
+
+
+def gridLayout(n_location, n_group, rng):
+    """
+    Centres of square cells SPACING meters wide filling the rows of a square
+    grid, as a population grid loaded as polygons.
+    :return: tuple with the n x 2 coordinates and the n x m population
+    """
+    columns = int(np.ceil(np.sqrt(n_location)))
+    cell = np.arange(n_location)
+    location = np.c_[cell % columns, cell // columns] * SPACING + SPACING / 2
+    share = rng.dirichlet(np.ones(n_group), n_location)
+    pop = rng.poisson(500 * share).astype(float)
+    return location, pop
+
+
+def syntheticLayout(layout, n_location, n_group, seed=0):
+    """
+    Build a synthetic layer.
+    :param layout: one of LAYOUTS
+    :return: tuple with tract ids, coordinates and population
+    """
+    rng = np.random.RandomState(seed)
+    build = {'uniform': uniformLayout, 'clustered': clusteredLayout, 'grid': gridLayout}
+    location, pop = build[layout](n_location, n_group, rng)
+    tract_id = np.arange(n_location).astype(str).reshape((n_location, 1))
+    return tract_id, location, pop
+
+
+def warmUp(options):
+    """
+    Import the modules the stages load on first use, so their import time is
+    not counted in the first run.
+    :param options: parsed command line options
+    """
+    for module in ('scipy.sparse', 'scipy.spatial', 'scipy.spatial.distance'):
+        importlib.import_module(module)
+    if options.format in ('parquet', 'arrow'):
+        arrowModule()
+
+
+def runStages(tract_id, location, pop, bandwidth, weightmethod, options, directory):
+    """
+    Run the plugin stages once on a layer and measure each one.
+    :param options: parsed command line options
+    :param directory: folder for the output files
+    :return: list of stage records
+    """
+    profile = StageProfile()
+    memory = options.memory
+
+    with profile.stage('cal_localityMatrix'):
+        locality, error = localityMatrix(location, pop, bandwidth, weightmethod, memory,
+                                         options.engine, options.tolerance, options.workers,
+                                         options.precision)
+    with profile.stage('cal_localExposure'):
+        local_exposure = localExposure(pop, locality, memory, options.precision)
+    with profile.stage('cal_localDissimilarity'):
+        local_dissimilarity = localDissimilarity(pop, locality, memory, options.precision)
+    with profile.stage('cal_localEntropy'):
+        local_entropy = localEntropy(pop, locality, memory, options.precision)
+    with profile.stage('globalMeasures'):
+        global_exposure = globalExposure(pop, locality, memory)
+        global_dissimilarity = globalDissimilarity(local_dissimilarity)
+        global_entropy = globalEntropy(pop)
+        local_indexh = localIndexH(pop, local_entropy, global_entropy)
+        global_indexh = globalIndexH(local_indexh)
+    with profile.stage('joinResultsData'):
+        result = joinResults(tract_id, np.asmatrix(np.c_[location, pop]), pop.shape[1],
+                             locality, local_exposure, local_dissimilarity, local_entropy,
+                             local_indexh)
+    path = os.path.join(directory, 'results.' + options.format)
+    with profile.stage('saveResults'):
+        writeTable(path, result, options.decimals)
+        writeGlobal(path + '_global.csv', global_dissimilarity, global_entropy,
+                    global_indexh, global_exposure)
+
+    profile.stages[-1]['bytes'] = os.path.getsize(path)
+    profile.stages[0]['truncation_error'] = error
+    return profile.stages
+
+
+def environment():
+    """Versions and hardware the benchmark ran on"""
+    return {'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': multiprocessing.cpu_count()}
+
+
+def benchmark(options):
+    """
+    Run every combination of layout, size, groups, bandwidth, kernel and engine.
+    :param options: parsed command line options
+    :return: dictionary with the environment and one record by run
+    """
+    runs = []
+    warmUp(options)
+    directory = tempfile.mkdtemp(prefix='segreg_benchmark_')
+    try:
+        for layout in options.layout:
+            for n_location in options.n:
+                for n_group in options.groups:
+                    tract_id, location, pop = syntheticLayout(layout, n_location, n_group,
+                                                              options.seed)
+                    for bandwidth in options.bandwidth:
+                        for kernel in options.kernel:
+                            for engine in options.engine:
+                                run = {'layout': layout, 'n': n_location, 'groups': n_group,
+                                       'bandwidth': bandwidth, 'kernel': kernel,
+                                       'engine': engine, 'precision': options.precision,
+                                       'memory': options.memory, 'workers': options.workers,
+                                       'tolerance': options.tolerance,
+                                       'format': options.format,
+                                       'decimals': options.decimals, 'repeats': []}
+                                sys.stderr.write('%(layout)s n=%(n)s groups=%(groups)s '
+                                                 'bandwidth=%(bandwidth)s %(kernel)s '
+                                                 '%(engine)s\n' % run)
+                                stage_options = argparse.Namespace(**vars(options))
+                                stage_options.engine = engine
+                                try:
+                                    for repeat in range(options.repeat):
+                                        run['repeats'].append(runStages(
+                                            tract_id, location, pop, bandwidth,
+                                            WEIGHT_METHODS[kernel], stage_options, directory))
+                                except Exception as error:
+                                    # e.g. the fft engine on a layout that is not a grid
+                                    run['error'] = str(error)
+                                runs.append(run)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {'environment': environment(), 'runs': runs}
+
+
+def parseArguments(argv=None):
+    """Command line options"""
+    parser = argparse.ArgumentParser(description='Benchmark the Segreg stages on synthetic '
+                                                 'tract layouts.')
+    parser.add_argument('--n', type=int, nargs='+', default=[1000, 5000],
+                        help='number of tracts')
+    parser.add_argument('--groups', type=int, nargs='+', default=[4], help='number of groups')
+    parser.add_argument('--bandwidth', type=float, nargs='+', default=[1000.0],
+                        help='bandwidth in meters')
+    parser.add_argument('--layout', nargs='+', choices=LAYOUTS, default=LAYOUTS)
+    parser.add_argument('--kernel', nargs='+', choices=sorted(WEIGHT_METHODS), default=['gaussian'])
+    parser.add_argument('--engine', nargs='+', choices=ENGINES, default=['auto'])
+    parser.add_argument('--precision', choices=PRECISIONS, default='float64')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='relative weight tolerance to truncate the gaussian')
+    parser.add_argument('--memory', type=int, default=1024, help='memory budget in megabytes')
+    parser.add_argument('--workers', type=int, default=1, help='processes for the intensity')
+    parser.add_argument('--format', choices=[extension for extension, label in outputFormats()
+                                             if extension != 'gpkg'],
+                        default='csv', help='output format of the local results')
+    parser.add_argument('--decimals', type=int, default=None,
+                        help='fixed decimals of csv values, exact values if empty')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each combination')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic layouts')
+    parser.add_argument('-o', '--output', default=None, help='JSON file, standard output if empty')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parseArguments(argv)
+    results = benchmark(options)
+    if options.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
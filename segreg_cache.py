@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ On-disk cache for centroids and spatial weights, so reruns on the same
+ geometry skip the spatial work.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+class SegregCache(object):
+    def __init__(self, directory, max_size=2048):
+        """
+        Constructor.
+        :param directory: folder where cached arrays are stored, created if needed
+        :param max_size: maximum size of the folder in megabytes, least recently
+            used entries are evicted above it
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(*parts):
+        """Build a cache key from a geometry hash and the computation parameters"""
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """File name holding a cache entry"""
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        """
+        Read the arrays stored for a key and mark the entry as recently used.
+        :param key: key from SegregCache.key
+        :return: dictionary with the arrays or None if not cached
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = dict((name, data[name]) for name in data.files)
+        except (IOError, OSError, ValueError):
+            return None
+
+        os.utime(path, None)
+        return arrays
+
+    def save(self, key, **arrays):
+        """
+        Store arrays for a key and evict old entries if the folder is too big.
+        The file is written aside and renamed so readers never see it partial.
+        :param key: key from SegregCache.key
+        :param arrays: arrays to be stored by name
+        """
+        handle, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(handle, 'wb') as f:
+            np.savez(f, **arrays)
+
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+        self.evict()
+
+    def loadWeights(self, key):
+        """Read a scipy CSR weight matrix, None if not cached"""
+        from scipy.sparse import csr_matrix
+        data = self.load(key)
+        if data is None:
+            return None
+        return csr_matrix((data['data'], data['indices'], data['indptr']),
+                          shape=tuple(data['shape']))
+
+    def saveWeights(self, key, weight):
+        """Store a scipy CSR weight matrix"""
+        self.save(key, data=weight.data, indices=weight.indices, indptr=weight.indptr,
+                  shape=np.asarray(weight.shape))
+
+    def evict(self):
+        """Remove least recently used entries until the folder fits on max_size"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(entry[1] for entry in entries)
+        limit = self.max_size * 1024 * 1024
+        for mtime, size, name in sorted(entries):
+            if total <= limit:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
@@ -0,0 +1,603 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Headless segregation engine: input, intensity, measures and output state
+ of a run, without Qt or QGIS. The plugin drives one instance from its
+ dialog, scripts can use it directly, for example:
+
+     engine = SegregEngine(memory=1024)
+     engine.setInput(tract_id, location, pop)
+     engine.bandwidthSweep([500, 1000], weightmethod=1)
+     engine.sweepMeasures()
+     engine.writeResults('results.csv')
+
+ SegregPanel does the same for several years of population on the same
+ tracts, the weights being built once for all the years.
+"""
+import numpy as np
+
+from segreg_intensity import (LatticeOperator, WeightOperator, droppedWeight, localitySweep,
+                              regularLattice, releaseScratch, scratchArray, selectEngine,
+                              sweepWeights)
+from segreg_measures import MEASURES, measureSet
+from segreg_output import (joinResults, outputFormat, significanceTable, stackResults, writeGlobal,
+                           writeGlobalTable, writeNullTable, writeTable)
+from segreg_significance import TESTED, monteCarlo
+
+# local measures joined to the result table, in column order
+LOCAL_MEASURES = ['local_exposure', 'local_dissimilarity', 'local_entropy', 'local_indexh']
+
+# kernel names by weight method
+KERNELS = {1: 'gaussian', 2: 'bi-square', 3: 'moving window'}
+
+# weight methods by the kernel names of the command line tools
+WEIGHT_METHODS = {'gaussian': 1, 'bisquare': 2, 'window': 3}
+
+
+def stepProgress(progress, step, steps):
+    """
+    Progress callback of one step out of several, reporting to progress the
+    work done over all the steps.
+    :param progress: callable receiving the work done and the total, or None
+    :param step: index of the step, starting at 0
+    :param steps: number of steps
+    :return: callable receiving the work done and the total of the step
+    """
+    if progress is None:
+        return None
+
+    def report(done, total):
+        progress(step * total + done, steps * total)
+    return report
+
+
+class SegregEngine(object):
+    def __init__(self, memory=1024, precision='float64', scratch=None, cache=None):
+        """
+        Constructor.
+        :param memory: memory budget in megabytes, None computes whole arrays at once
+        :param precision: floating point type of intensity and measures, one
+            of PRECISIONS
+        :param scratch: directory of the memory-mapped arrays, None to keep
+            them in memory
+        :param cache: optional SegregCache of the sparse weights, used when a
+            geometry key is given to setInput
+        """
+        self.memory = memory
+        self.precision = precision
+        self.scratch = scratch
+        self.cache = cache
+        self.clear()
+
+    def clear(self):
+        """Forget the input, the weight operators and all the results"""
+        self.attributeMatrix = np.matrix([])    # x, y and the population of each group
+        self.location = []                      # x and y coordinates from tract centroid
+        self.pop = []                           # population of each groups by tract
+        self.pop_sum = []                       # total population of the tract (sum all groups)
+        self.tract_id = []                      # tract ids in string format
+        self.n_location = 0                     # number of tracts
+        self.n_group = 0                        # number of groups
+        self.geometryKey = None                 # cache key of the input geometry
+        self.operators = {}                     # weight operators kept for the input geometry
+        self.exposurePairs = None               # group pairs of local exposure, None for all
+
+        self.locality = []                      # population intensity by groups by tract
+        self.localityError = 0.0                # max error bound from kernel truncation
+        self.bandwidths = []                    # bandwidths of the intensity sweep
+        self.localitySweep = []                 # population intensity by bandwidth (3D array)
+        self.sweepResults = []                  # measures computed for each bandwidth
+        self.weightmethod = None                # kernel of the intensity computed
+        self.engine = None                      # engine selected for the intensity
+        self.tolerance = None                   # gaussian truncation of the intensity
+        self.significance = None                # Monte Carlo p-values, see monteCarlo
+        self.clearMeasures()
+        releaseScratch()
+
+    def clearMeasures(self):
+        """clear local and global results"""
+        for name in MEASURES:
+            setattr(self, name, [])
+
+    def setInput(self, tract_id, location, pop, geometryKey=None):
+        """
+        Set the tracts of a new input. Negative populations are read as zero.
+        Weight operators are kept while the centroids don't change.
+        :param tract_id: n ids, None to number the tracts from 0
+        :param location: n x 2 array like with x and y of the tract centroids
+        :param pop: n x m array like with the population of each group
+        :param geometryKey: key of the geometry in the cache, see SegregCache.key
+        """
+        data = np.concatenate((np.asarray(location, dtype=float),
+                               np.asarray(pop, dtype=float)), axis=1)
+        self.attributeMatrix = np.asmatrix(data)
+        n = self.attributeMatrix.shape[1]
+        previous = self.location
+        self.location = self.attributeMatrix[:, 0:2]
+        self.location = self.location.astype('float')
+        if not np.array_equal(previous, self.location):
+            self.operators = {}
+            releaseScratch()
+
+        self.pop = self.attributeMatrix[:, 2:n]
+        self.pop[np.where(self.pop < 0)[0], np.where(self.pop < 0)[1]] = 0.0
+        self.n_group = n - 2
+        self.n_location = self.attributeMatrix.shape[0]
+        self.pop_sum = np.sum(self.pop, axis=1)
+        if tract_id is None:
+            tract_id = np.arange(self.n_location).astype(str)
+        self.tract_id = np.asarray(tract_id).reshape((self.n_location, 1))
+        self.geometryKey = geometryKey
+
+    def problemSize(self):
+        """Size and parameters of the current problem, stored with the stage records"""
+        return {'n': self.n_location,
+                'groups': self.n_group,
+                'bandwidth': ','.join(str(bw) for bw in self.bandwidths) or None,
+                'kernel': KERNELS.get(self.weightmethod),
+                'engine': self.engine,
+                'precision': self.precision}
+
+    def cachedWeights(self, bandwidths, weightmethod, tolerance=None, progress=None):
+        """
+        Read the sparse weights of each bandwidth from the cache, the missing
+        ones are computed in a single neighbour search and stored.
+        :param bandwidths: list of bandwidths for neighborhood in meters
+        :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+        :param tolerance: relative weight tolerance to truncate the gaussian
+        :param progress: optional callable receiving the work done and the total
+        :return: list of scipy CSR weight matrices, one by bandwidth
+        """
+        if weightmethod != 1:
+            tolerance = None
+        keys = [self.cache.key(self.geometryKey, 'weights', weightmethod, bw, tolerance,
+                               self.precision) for bw in bandwidths]
+        weights = [self.cache.loadWeights(key) for key in keys]
+
+        missing = [index for index, weight in enumerate(weights) if weight is None]
+        if missing:
+            computed = sweepWeights(self.location, [bandwidths[i] for i in missing],
+                                    weightmethod, tolerance, self.precision, progress)
+            for index, weight in zip(missing, computed):
+                self.cache.saveWeights(keys[index], weight)
+                weights[index] = weight
+
+        return weights
+
+    def weightOperators(self, weightmethod, memory=None, engine='auto', tolerance=None,
+                        workers=1, progress=None):
+        """
+        Weight operators of the input for each bandwidth of self.bandwidths.
+        They are kept while the centroids stay the same, so the intensity of
+        another set of groups, or of groups added later, is a single product.
+        Sparse weights go through the cache when there is one and the input
+        has a geometry key. On a regular lattice the fft engine keeps the
+        kernel spectrum instead. Dense operators are n x n, they are only kept
+        if they fit in the memory budget together with a block of distance
+        rows, with or without a scratch directory. The blocks that build and
+        apply them get what is left of the budget, and the dense operators of
+        other bandwidths or kernels are dropped first.
+        With more than one worker, operators not kept yet are not built on the
+        calling process and the rows are streamed over the process pool.
+        :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+        :param memory: memory budget in megabytes
+        :param engine: one of ENGINES
+        :param tolerance: relative weight tolerance to truncate the gaussian
+        :param workers: number of processes selected to compute the intensity
+        :param progress: optional callable receiving the work done and the total
+        :return: list of WeightOperator or LatticeOperator, one by bandwidth, or
+            None to stream rows
+        """
+        engine = selectEngine(weightmethod, engine, tolerance, self.location)
+        if weightmethod != 1:
+            tolerance = None
+        keys = [(weightmethod, bw, tolerance, self.precision, engine) for bw in self.bandwidths]
+        missing = [key[1] for key in keys if key not in self.operators]
+        if missing and workers > 1 and engine != 'fft':
+            return None
+        if missing and engine == 'dense':
+            self.operators = dict((key, operator) for key, operator in self.operators.items()
+                                  if key in keys or not getattr(operator, 'dense', False))
+            size = WeightOperator.fullSize(self.n_location, self.precision) * len(self.bandwidths)
+            if memory is not None:
+                if size + WeightOperator.rowSize(self.n_location, self.precision) > memory:
+                    return None
+                memory -= size
+
+        if missing:
+            if engine == 'sparse' and self.cache is not None and self.geometryKey is not None:
+                weights = self.cachedWeights(missing, weightmethod, tolerance, progress)
+                built = [WeightOperator(weight, droppedWeight(self.location, weight, bandwidth,
+                                                              tolerance))
+                         for weight, bandwidth in zip(weights, missing)]
+            elif engine == 'sparse':
+                built = WeightOperator.sparse(self.location, missing, weightmethod, tolerance,
+                                              self.precision, progress)
+            elif engine == 'fft':
+                lattice = regularLattice(self.location)
+                built = [LatticeOperator(self.location, bandwidth, weightmethod, tolerance,
+                                         memory, lattice) for bandwidth in missing]
+            else:
+                built = WeightOperator.full(self.location, missing, weightmethod, memory,
+                                            self.scratch, self.precision, progress)
+            for bandwidth, operator in zip(missing, built):
+                self.operators[(weightmethod, bandwidth, tolerance, self.precision,
+                                engine)] = operator
+
+        return [self.operators[key] for key in keys]
+
+    def localityMatrix(self, bandwidth, weightmethod, engine='auto', tolerance=None, workers=1,
+                       progress=None):
+        """
+        Compute the local population intensity for all groups, kept at
+        self.locality.
+        :param bandwidth: bandwidth for neighborhood in meters
+        :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+        :param engine: 'auto', 'dense', 'sparse' (KD-tree neighbours, compact kernels)
+            or 'fft' (convolution, centroids on a regular grid)
+        :param tolerance: relative weight tolerance to truncate the gaussian, the
+            resulting error bound is kept at self.localityError
+        :param workers: number of processes sharing the rows
+        :param progress: optional callable receiving the work done and the total,
+            it may raise an exception to stop the computation
+        :return: 2d array like with population intensity for all groups
+        """
+        self.bandwidthSweep([bandwidth], weightmethod, engine, tolerance, workers, progress)
+        return self.locality
+
+    def bandwidthSweep(self, bandwidths, weightmethod, engine='auto', tolerance=None, workers=1,
+                       progress=None):
+        """
+        Compute the local population intensity for several bandwidths in one
+        pass, distances or neighbour lists being computed a single time. The
+        intensity of the first bandwidth is also kept at self.locality. An
+        interrupted run keeps the previous intensity.
+        :param bandwidths: list of bandwidths for neighborhood in meters
+        :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+        :return: 3d array like with population intensity by bandwidth
+        """
+        previous = self.bandwidths, self.weightmethod, self.engine, self.tolerance
+        self.bandwidths = list(bandwidths)
+        self.weightmethod = weightmethod
+        self.engine = engine
+        self.tolerance = tolerance
+        try:
+            sweep, errors = self.computeSweep(weightmethod, engine, tolerance, workers, progress)
+        except Exception:
+            self.bandwidths, self.weightmethod, self.engine, self.tolerance = previous
+            raise
+
+        self.localitySweep = sweep
+        self.locality = self.localitySweep[0]
+        self.localityError = float(np.max(errors))
+        self.sweepResults = []
+        releaseScratch()
+        return self.localitySweep
+
+    def computeSweep(self, weightmethod, engine='auto', tolerance=None, workers=1,
+                     progress=None):
+        """
+        Compute the population intensity of each bandwidth of self.bandwidths,
+        see bandwidthSweep.
+        :return: tuple with the 3d intensity array (bandwidth, tract, group) and
+            the maximum truncation error by bandwidth
+        """
+        out = scratchArray((len(self.bandwidths), self.n_location, self.n_group), self.scratch,
+                           self.precision)
+
+        # kept weight operators are applied to the groups, otherwise rows are streamed
+        operators = self.weightOperators(weightmethod, self.memory, engine, tolerance, workers,
+                                         stepProgress(progress, 0, 2))
+        if operators is not None:
+            errors = []
+            for index, operator in enumerate(operators):
+                out[index], error = operator.apply(self.pop)
+                errors.append(error)
+                if progress is not None:
+                    stepProgress(progress, 1, 2)(index + 1, len(operators))
+            sweep = out
+        else:
+            sweep, errors = localitySweep(self.location, self.pop, self.bandwidths, weightmethod,
+                                          self.memory, engine, tolerance, workers, out,
+                                          self.precision, progress)
+        return sweep, errors
+
+    def computeMeasures(self, measures=MEASURES, progress=None):
+        """
+        Compute the measures and the ones they depend on for the current
+        intensity, each one once, see measureSet. The non spatial version is
+        computed if there is no intensity. Results are kept as attributes
+        named after the measures.
+        :param measures: list of names from MEASURES
+        :param progress: optional callable receiving the work done and the total
+        :return: dictionary with the measures computed by name
+        """
+        results = measureSet(self.pop, self.locality, measures, self.memory, self.precision,
+                             self.scratch, progress, self.exposurePairs)
+        for name, value in results.items():
+            setattr(self, name, value)
+        releaseScratch()
+        return results
+
+    def sweepMeasures(self, measures=MEASURES, progress=None):
+        """
+        Compute the measures for each bandwidth of the intensity sweep.
+        Intensity and measures of every bandwidth are kept at self.sweepResults
+        and the ones of the first bandwidth are left loaded.
+        :param measures: list of names from MEASURES
+        :param progress: optional callable receiving the work done and the total
+        :return: list of dictionaries with bandwidth, intensity and measures
+        """
+        self.sweepResults = []
+        for index, bandwidth in enumerate(self.bandwidths):
+            self.locality = self.localitySweep[index]
+            self.clearMeasures()
+            try:
+                self.computeMeasures(measures,
+                                     stepProgress(progress, index, len(self.bandwidths)))
+            except Exception:
+                # an interrupted sweep leaves the first intensity and no measures
+                self.locality = self.localitySweep[0]
+                self.clearMeasures()
+                self.sweepResults = []
+                raise
+            result = {'bandwidth': bandwidth, 'locality': self.locality}
+            for name in MEASURES:
+                result[name] = getattr(self, name)
+            self.sweepResults.append(result)
+
+        self.loadSweepResult(0)
+        return self.sweepResults
+
+    def loadSweepResult(self, index):
+        """Set intensity and measures from one bandwidth of the sweep as current"""
+        for name, value in self.sweepResults[index].items():
+            if name != 'bandwidth':
+                setattr(self, name, value)
+
+    def results(self, measures=None):
+        """
+        Join the input, intensity and local measures on a typed column table.
+        :param measures: names from LOCAL_MEASURES to be joined, None for the
+            ones computed
+        :return: ResultTable, see joinResults
+        """
+        local = []
+        for name in LOCAL_MEASURES:
+            value = getattr(self, name)
+            if measures is None and len(value) == 0:
+                value = None
+            elif measures is not None and name not in measures:
+                value = None
+            local.append(value)
+        return joinResults(self.tract_id, self.attributeMatrix, self.n_group, self.locality,
+                           local[0], local[1], local[2], local[3], self.exposurePairs)
+
+    def writeResults(self, path, decimals=None, measures=None):
+        """
+        Write the local results on the format given by the file extension, and
+        the global results to <path>_global.csv. One pair of files is written
+        for each bandwidth of a sweep, named <root>_bw<bandwidth>.<extension>.
+        :param path: output file name, see outputFormat
+        :param decimals: fixed decimals of csv values, None for exact values
+        :param measures: names from LOCAL_MEASURES to be written, None for the
+            ones computed
+        :return: list of the local result files written
+        """
+        paths = [path]
+        if len(self.sweepResults) > 1:
+            extension = outputFormat(path)
+            if extension is None:
+                raise Exception('Output format not supported!')
+            root = path[:-len(extension) - 1]
+            paths = ['%s_bw%s.%s' % (root, sweep['bandwidth'], extension)
+                     for sweep in self.sweepResults]
+
+        for index, name in enumerate(paths):
+            if len(paths) > 1:
+                self.loadSweepResult(index)
+            writeTable(name, self.results(measures), decimals)
+            writeGlobal('%s_global.csv' % name, self.global_dissimilarity, self.global_entropy,
+                        self.global_indexh, self.global_exposure)
+        if len(paths) > 1:
+            self.loadSweepResult(0)
+        return paths
+
+    def monteCarlo(self, measures=TESTED, replicates=999, method=None, seed=0,
+                   bandwidth=None, workers=1, progress=None):
+        """
+        Pseudo p-values of the local measures against random populations,
+        kept at self.significance. The replicates reuse the weight operator of
+        the intensity computed, by batches within the memory budget, and the
+        non spatial measures are tested when there is no intensity. Random
+        populations only depend on the seed, not on the batches or workers.
+        :param measures: list of names from TESTED
+        :param replicates: number of random populations
+        :param method: one of NULL_MODELS, see randomPopulation, None for
+            permutation with an intensity and multinomial without
+        :param seed: integer seed of the random states
+        :param bandwidth: bandwidth of the sweep tested, None for the first one
+        :param workers: number of processes sharing the replicates
+        :param progress: optional callable receiving the work done and the total
+        :return: dictionary with observed values, p-values and global null
+            distributions, see segreg_significance.monteCarlo
+        """
+        operator = None
+        if len(self.bandwidths) > 0:
+            if bandwidth is None:
+                bandwidth = self.bandwidths[0]
+            if bandwidth not in self.bandwidths:
+                raise Exception('Bandwidth %s not computed!' % bandwidth)
+            operators = self.weightOperators(self.weightmethod, self.memory, self.engine,
+                                             self.tolerance)
+            if operators is None:
+                raise Exception('Weights too large for the memory budget, '
+                                'increase it or use the sparse engine!')
+            operator = operators[self.bandwidths.index(bandwidth)]
+
+        self.significance = monteCarlo(self.pop, operator, measures, replicates, method, seed,
+                                       self.memory, workers, progress)
+        self.significance['bandwidth'] = bandwidth
+        return self.significance
+
+    def writeSignificance(self, path, decimals=None):
+        """
+        Write the observed local measures and their p-values on the format
+        given by the file extension, and the global null distributions with
+        the observed values and p-values to <path>_null.csv.
+        :param path: output file name, see outputFormat
+        :param decimals: fixed decimals of csv values, None for exact values
+        """
+        if self.significance is None:
+            raise Exception('No significance test computed!')
+        writeTable(path, significanceTable(self.tract_id, self.significance), decimals)
+        writeNullTable('%s_null.csv' % path, self.significance)
+
+
+class SegregPanel(object):
+    def __init__(self, memory=1024, precision='float64', scratch=None, cache=None):
+        """
+        Constructor. Census years on a fixed geometry: the groups of every
+        year are stacked as the columns of a single input, so each weight
+        operator is built once and applied to all the years in one product,
+        then the measures are computed by year. Options as SegregEngine.
+        """
+        self.core = SegregEngine(memory, precision, scratch, cache)
+        self.years = []                         # year of each population matrix
+        self.engines = []                       # SegregEngine of each year
+        self.n_group = 0                        # number of groups of each year
+
+    def setInput(self, tract_id, location, pops, years=None, geometryKey=None):
+        """
+        Set the tracts and the population of each year.
+        :param tract_id: n ids, None to number the tracts from 0
+        :param location: n x 2 array like with x and y of the tract centroids
+        :param pops: list of n x m array like with the population of each
+            group, one by year, with the same groups in the same order
+        :param years: list with the year of each population, 0, 1, ... if None
+        :param geometryKey: key of the geometry in the cache, see SegregCache.key
+        """
+        pops = [np.asarray(pop, dtype=float) for pop in pops]
+        if len(pops) == 0 or any(pop.shape != pops[0].shape for pop in pops):
+            raise Exception('Populations of every year must have the same tracts and groups!')
+        if years is None:
+            years = list(range(len(pops)))
+        if len(years) != len(pops):
+            raise Exception('One year is needed by population!')
+
+        self.years = list(years)
+        self.n_group = pops[0].shape[1]
+        self.core.setInput(tract_id, location, np.concatenate(pops, axis=1), geometryKey)
+        self.engines = []
+        for pop in pops:
+            engine = SegregEngine(self.core.memory, self.core.precision, self.core.scratch)
+            engine.setInput(self.core.tract_id, location, pop)
+            self.engines.append(engine)
+
+    def bandwidthSweep(self, bandwidths, weightmethod, engine='auto', tolerance=None, workers=1,
+                       progress=None):
+        """
+        Compute the population intensity of every year for several bandwidths,
+        see SegregEngine.bandwidthSweep. All the years go through the same
+        weights in one pass, each year engine getting its columns.
+        :return: 3d array like with the intensity by bandwidth, the groups of
+            each year one after the other
+        """
+        sweep = self.core.bandwidthSweep(bandwidths, weightmethod, engine, tolerance, workers,
+                                         progress)
+        for index, part in enumerate(self.engines):
+            part.localitySweep = sweep[:, :, index * self.n_group:(index + 1) * self.n_group]
+            part.locality = part.localitySweep[0]
+            part.localityError = self.core.localityError
+            part.bandwidths = self.core.bandwidths
+            part.weightmethod = self.core.weightmethod
+            part.engine = self.core.engine
+            part.sweepResults = []
+            part.clearMeasures()
+        return sweep
+
+    def computeMeasures(self, measures=MEASURES, progress=None):
+        """
+        Compute the measures of every year, for each bandwidth of the intensity
+        if it was computed, otherwise the non spatial version.
+        :param measures: list of names from MEASURES
+        :param progress: optional callable receiving the work done and the total
+        """
+        for index, engine in enumerate(self.engines):
+            engine.memory, engine.precision = self.core.memory, self.core.precision
+            engine.scratch = self.core.scratch
+            engine.exposurePairs = self.core.exposurePairs
+            step = stepProgress(progress, index, len(self.engines))
+            if len(engine.bandwidths) > 0:
+                engine.sweepMeasures(measures, step)
+            else:
+                engine.computeMeasures(measures, step)
+
+    def loadSweepResult(self, index):
+        """Set intensity and measures of one bandwidth as current for every year"""
+        for engine in self.engines:
+            if engine.sweepResults:
+                engine.loadSweepResult(index)
+
+    def results(self, measures=None):
+        """
+        Long format table of the current bandwidth, one row by year and tract.
+        :param measures: names from LOCAL_MEASURES to be joined, None for the
+            ones computed
+        :return: ResultTable with a year column, see stackResults
+        """
+        return stackResults([engine.results(measures) for engine in self.engines], self.years)
+
+    def globalResults(self):
+        """
+        Global measures of the current bandwidth.
+        :return: list of dictionaries with the global measures by name, one by year
+        """
+        return [dict((name, getattr(engine, name)) for name in MEASURES
+                     if name.startswith('global')) for engine in self.engines]
+
+    def writeResults(self, path, decimals=None, measures=None):
+        """
+        Write the long format local results on the format given by the file
+        extension and the global results by year to <path>_global.csv, one
+        pair of files by bandwidth named as SegregEngine.writeResults.
+        :param path: output file name, see outputFormat
+        :param decimals: fixed decimals of csv values, None for exact values
+        :param measures: names from LOCAL_MEASURES to be written, None for the
+            ones computed
+        :return: list of the local result files written
+        """
+        bandwidths = self.core.bandwidths
+        paths = [path]
+        if len(bandwidths) > 1:
+            extension = outputFormat(path)
+            if extension is None:
+                raise Exception('Output format not supported!')
+            root = path[:-len(extension) - 1]
+            paths = ['%s_bw%s.%s' % (root, bandwidth, extension) for bandwidth in bandwidths]
+
+        for index, name in enumerate(paths):
+            self.loadSweepResult(index)
+            writeTable(name, self.results(measures), decimals)
+            writeGlobalTable('%s_global.csv' % name, self.years, self.globalResults())
+        self.loadSweepResult(0)
+        return paths
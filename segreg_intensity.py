@@ -0,0 +1,1012 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Population intensity engine. Only numpy and scipy are used here, so the
+ functions can be called without a QGIS session. Scipy is imported by the
+ functions that use it, so importing the module stays fast.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import weakref
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+# engines available to compute the population intensity
+ENGINES = ['auto', 'dense', 'sparse', 'fft']
+
+# floating point types for intensity and measures, sums are always double
+PRECISIONS = ['float64', 'float32']
+
+# columns of a single precision product summed before adding to a double total
+ACCUMULATE = 4096
+
+# largest ratio of lattice cells to locations accepted as a regular grid
+LATTICE_FILL = 4
+
+# most rows of a sparse engine block, and number of blocks to report progress
+SPARSE_ROWS = 8192
+PROGRESS_STEPS = 20
+
+# cells of the truncation error bound by truncation distance, and largest
+# number of cells along an axis
+BOUND_SPLIT = 32
+BOUND_CELLS = 1024
+
+
+
+# arrays shared with the worker processes, populated by _initWorker
+_worker = {}
+
+# weak references to the memory-mapped arrays of scratchArray by file name
+_scratchFiles = {}
+
+
+def kernelWeight(distance, bandwidth, weightmethod=1):
+    """
+    Compute the neighborhood weights for an array of distances of any shape.
+    :param distance: array like with distances in meters
+    :param bandwidth: bandwidth in meters selected to perform neighborhood
+    :param weightmethod: method to be used: 1-gussian , 2-bi square and 3-moving window
+    :return: array with the same shape of distance holding the weights
+    """
+    distance = np.asarray(distance)
+
+    if weightmethod == 1:
+        weight = np.exp((-0.5) * (distance / bandwidth) * (distance / bandwidth))
+
+    elif weightmethod == 2:
+        weight = (1 - (distance / bandwidth) * (distance / bandwidth)) * (
+        1 - (distance / bandwidth) * (distance / bandwidth))
+        weight[distance > bandwidth] = 0
+
+    elif weightmethod == 3:
+        weight = (1 + (distance * 0))
+        weight[distance > bandwidth] = 0
+
+    else:
+        raise Exception('Invalid weight method selected!')
+
+    return weight
+
+
+def blockSize(n_location, memory=None, itemsize=8):
+    """
+    Number of rows processed at once so that a block of distances and its
+    weights fits in the memory budget. Besides the double precision distance
+    rows the kernel evaluation keeps up to three temporaries of the same size
+    alive.
+    :param n_location: number of locations (columns of each block)
+    :param memory: memory budget in megabytes, None for a single block
+    :param itemsize: bytes per value of the kernel temporaries
+    :return: number of rows per block, at least one
+    """
+    if memory is None:
+        return max(1, n_location)
+
+    rows = int(memory * 1024 * 1024 // ((8 + 3 * itemsize) * max(1, n_location)))
+    return max(1, min(n_location, rows))
+
+
+def scratchArray(shape, directory=None, dtype=float):
+    """
+    Allocate an array of floats, backed by a memory-mapped file when a scratch
+    directory is given so it can exceed the available memory. The file is
+    removed by releaseScratch once the array is no longer used, the directory
+    is owned by the caller.
+    :param shape: shape of the array
+    :param directory: scratch directory or None for an in-memory array
+    :param dtype: floating point type of the array
+    :return: numpy array or numpy.memmap
+    """
+    shape = tuple(int(x) for x in shape)
+    if directory is None or np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+
+    releaseScratch()
+    handle, path = tempfile.mkstemp(suffix='.dat', dir=directory)
+    os.close(handle)
+    array = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+    _scratchFiles[path] = weakref.ref(array)
+    return array
+
+
+def releaseScratch():
+    """
+    Remove the files of the memory-mapped arrays from scratchArray that were
+    released. A file still mapped by a view is kept for a later call where it
+    can't be removed (Windows), elsewhere its space is freed once unmapped.
+    """
+    for path, array in list(_scratchFiles.items()):
+        if array() is not None:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            if os.path.exists(path):
+                continue
+        del _scratchFiles[path]
+
+
+def localityBlock(distance, pop, bandwidth, weightmethod):
+    """
+    Compute the population intensity of a block of locations from their
+    distances to all the locations. The weights of the block are computed once
+    and applied to every group column in one matrix product. In single
+    precision the product is taken by chunks of ACCUMULATE columns summed in
+    double, as are the weight row sums.
+    :param distance: 2d array with the distances from the block rows to all
+        tracts, its type sets the precision of the weights
+    :param pop: 2d array with the population of each group by tract, of the
+        same type as distance
+    :param bandwidth: bandwidth for neighborhood in meters
+    :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+    :return: 2d array with population intensity of the block rows
+    """
+    weight = kernelWeight(distance, bandwidth, weightmethod)
+    if weight.dtype == np.float64:
+        return weight.dot(pop) / np.sum(weight, axis=1)[:, None]
+
+    return weightProduct(weight, pop) / np.sum(weight, axis=1, dtype=np.float64)[:, None]
+
+
+def weightProduct(weight, pop):
+    """
+    Product of a dense block of weights by the population columns. In single
+    precision it is taken by chunks of ACCUMULATE columns summed in double.
+    :param weight: 2d array with the weights of some rows against all tracts
+    :param pop: 2d array with the population of each group by tract, of the
+        same type as weight
+    :return: 2d array with the weighted population sums of the rows
+    """
+    if weight.dtype == np.float64:
+        return weight.dot(pop)
+
+    total = np.zeros([weight.shape[0], pop.shape[1]])
+    for first in range(0, weight.shape[1], ACCUMULATE):
+        total += weight[:, first:first + ACCUMULATE].dot(pop[first:first + ACCUMULATE])
+    return total
+
+
+def truncationDistance(bandwidth, tolerance):
+    """
+    Distance beyond which the gaussian weight falls below a tolerance relative
+    to its peak, exp(-0.5 * (d / bandwidth)^2) < tolerance.
+    :param bandwidth: bandwidth for neighborhood in meters
+    :param tolerance: relative weight tolerance, between 0 and 1
+    :return: truncation distance in meters
+    """
+    if not 0 < tolerance < 1:
+        raise Exception('Tolerance must be between 0 and 1!')
+
+    return bandwidth * np.sqrt(-2.0 * np.log(tolerance))
+
+
+def neighbourRadius(bandwidth, weightmethod, tolerance=None):
+    """
+    Distance beyond which the weights of a kernel are zero. The gaussian has
+    one only when a tolerance is given, see truncationDistance.
+    :param bandwidth: bandwidth for neighborhood in meters
+    :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+    :param tolerance: relative weight tolerance to truncate the gaussian
+    :return: radius in meters
+    """
+    if weightmethod in (2, 3):
+        return bandwidth
+    elif weightmethod == 1 and tolerance is not None:
+        return truncationDistance(bandwidth, tolerance)
+    else:
+        raise Exception('Sparse engine requires a compact or truncated kernel!')
+
+
+def neighbourDistances(location, radius, start=0, stop=None, tree=None):
+    """
+    Search through a KD-tree the pairs of locations within a radius, so the
+    cost is O(n.k) for k neighbours instead of the O(n^2) dense distances.
+    :param location: 2d array with x and y coordinates of all tracts
+    :param radius: search radius in meters
+    :param start: first row of the distances to be built
+    :param stop: row after the last one to be built, None for all rows
+    :param tree: cKDTree of all the locations, built if None
+    :return: (stop - start) x n scipy CSR matrix with the distances, the
+        zero distance of each location to itself is kept explicitly
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.spatial import cKDTree
+
+    n_local = location.shape[0]
+    if stop is None:
+        stop = n_local
+
+    if tree is None:
+        tree = cKDTree(location)
+    if start == 0 and stop == n_local:
+        rows_tree = tree
+    else:
+        rows_tree = cKDTree(location[start:stop])
+
+    try:
+        distance = rows_tree.sparse_distance_matrix(tree, radius, output_type='coo_matrix')
+        data, row, col = distance.data, distance.row, distance.col
+    except TypeError:
+        # scipy before 0.19 only returns a dok matrix, which drops the zero
+        # distances to the location itself and to coincident locations
+        distance = rows_tree.sparse_distance_matrix(tree, radius).tocoo()
+        coincident = tree.query_ball_point(location[start:stop], 0.0)
+        data = np.concatenate([distance.data, np.zeros(sum(map(len, coincident)))])
+        row = np.concatenate([distance.row, np.repeat(np.arange(stop - start),
+                                                      [len(pairs) for pairs in coincident])])
+        col = np.concatenate([distance.col] + [np.asarray(pairs, dtype=int)
+                                               for pairs in coincident])
+    return csr_matrix((data, (row, col)), shape=(stop - start, n_local))
+
+
+def sparseWeights(distance, bandwidth, weightmethod, tolerance=None, dtype=float):
+    """
+    Evaluate a compact or truncated kernel on sparse neighbour distances. Pairs
+    beyond the kernel radius are dropped, so distances searched once for the
+    largest of several bandwidths serve all of them.
+    :param distance: scipy CSR matrix from neighbourDistances
+    :param bandwidth: bandwidth for neighborhood in meters
+    :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+    :param tolerance: relative weight tolerance to truncate the gaussian
+    :param dtype: floating point type of the weights
+    :return: scipy CSR matrix with the weights
+    """
+    weight = distance.copy()
+    weight.data = kernelWeight(distance.data.astype(dtype), bandwidth, weightmethod)
+    weight.data[distance.data > neighbourRadius(bandwidth, weightmethod, tolerance)] = 0
+    weight.eliminate_zeros()
+    return weight
+
+
+def neighbourWeights(location, bandwidth, weightmethod, tolerance=None, start=0, stop=None,
+                     dtype=float):
+    """
+    Build the sparse weight matrix of a compact kernel from the neighbours
+    within the bandwidth. The gaussian is accepted when a tolerance is given
+    and it is cut at the corresponding truncationDistance.
+    :param location: 2d array with x and y coordinates of all tracts
+    :param bandwidth: bandwidth for neighborhood in meters
+    :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+    :param tolerance: relative weight tolerance to truncate the gaussian
+    :param start: first row of the weights to be built
+    :param stop: row after the last one to be built, None for all rows
+    :param dtype: floating point type of the weights
+    :return: (stop - start) x n scipy CSR matrix with the weights
+    """
+    radius = neighbourRadius(bandwidth, weightmethod, tolerance)
+    distance = neighbourDistances(location, radius, start, stop)
+    return sparseWeights(distance, bandwidth, weightmethod, tolerance, dtype)
+
+
+def droppedBound(location, bandwidth, tolerance, count, start=0, stop=None):
+    """
+    Upper bound of the gaussian weight that truncation drops on each row.
+    Tracts are counted on square cells and each pair of cells is given the
+    kernel at the shortest distance between them, so a dropped pair weighs at
+    most that value, or tolerance when the cells are closer than the
+    truncation distance. The cell counts are convolved with these values by
+    FFT and the kept pairs, each bounded by tolerance too, are taken off.
+    Cells are BOUND_SPLIT times smaller than the truncation distance, with at
+    most BOUND_CELLS of them along an axis.
+    :param location: 2d array with x and y coordinates of all tracts
+    :param bandwidth: bandwidth for neighborhood in meters
+    :param tolerance: relative weight tolerance used to truncate the kernel
+    :param count: 1d array with the number of pairs kept by row
+    :param start: first row of the bound
+    :param stop: row after the last one, None for all rows
+    :return: 1d array with the dropped weight bound by row
+    """
+    location = np.asarray(location, dtype=float)
+    if stop is None:
+        stop = location.shape[0]
+
+    radius = truncationDistance(bandwidth, tolerance)
+    origin = location.min(axis=0)
+    extent = float(np.max(location.max(axis=0) - origin))
+    size = max(radius / float(BOUND_SPLIT), extent / (BOUND_CELLS - 1)) or 1.0
+    cell = np.floor((location - origin) / size).astype(int)
+    shape = tuple(cell.max(axis=0) + 1)
+    grid = np.zeros(shape)
+    np.add.at(grid, (cell[:, 0], cell[:, 1]), 1)
+
+    # kernel at the shortest distance between cells, tolerance within the radius
+    gap_x = np.maximum(np.abs(np.arange(1 - shape[0], shape[0])) - 1, 0) * size
+    gap_y = np.maximum(np.abs(np.arange(1 - shape[1], shape[1])) - 1, 0) * size
+    gap = np.hypot(gap_x[:, None], gap_y[None, :])
+    kernel = np.where(gap < radius, tolerance, kernelWeight(gap, bandwidth, 1))
+
+    fft_shape = (fastLength(2 * shape[0] - 1), fastLength(2 * shape[1] - 1))
+    total = np.fft.irfft2(np.fft.rfft2(grid, fft_shape) * np.fft.rfft2(kernel, fft_shape),
+                          fft_shape)
+    rows = cell[start:stop]
+    bound = total[rows[:, 0] + shape[0] - 1, rows[:, 1] + shape[1] - 1]
+    return np.maximum(bound - tolerance * np.asarray(count), 0.0)
+
+
+def droppedWeight(location, weight, bandwidth, tolerance, start=0, reach=None):
+    """
+    Bound of the weight dropped on each row of a truncated sparse weight
+    matrix, see droppedBound.
+    :param location: 2d array with x and y coordinates of all tracts
+    :param weight: scipy CSR matrix with the kept weights of the rows
+        start:start + k against all the tracts
+    :param bandwidth: bandwidth for neighborhood in meters
+    :param tolerance: relative weight tolerance the gaussian was truncated
+        with, None if the weights are exact
+    :param start: first row of the weights
+    :param reach: 1d array with the bound of the rows before taking off the
+        kept pairs, droppedBound with no pair kept, computed if None
+    :return: 1d array with the bound by row, None if the weights are exact
+    """
+    if tolerance is None:
+        return None
+    count = np.diff(weight.indptr)
+    if reach is None:
+        return droppedBound(location, bandwidth, tolerance, count, start,
+                            start + weight.shape[0])
+    return np.maximum(reach - tolerance * count, 0.0)
+
+
+def truncationBound(dropped, kept, pop, locality):
+    """
+    Upper bound of the absolute error that truncating the kernel introduces on
+    the population intensity. A row misses at most the dropped weight, and the
+    dropped neighbours can only pull its intensity towards the group minimum
+    or maximum population.
+    :param dropped: 1d array with the largest weight sum dropped on each row
+    :param kept: 1d array with the weight sum kept on each row
+    :param pop: 2d array with the population of each group by tract
+    :param locality: 2d array with the truncated population intensity of the rows
+    :return: maximum error bound over the rows and groups
+    """
+    if len(kept) == 0:
+        return 0.0
+
+    share = dropped / (kept + dropped)
+    spread = np.maximum(pop.max(axis=0) - locality, locality - pop.min(axis=0))
+    return float(np.max(share[:, None] * spread))
+
+
+def sparseBlock(n_rows):
+    """
+    Number of rows of the sparse engine blocks, so progress is reported about
+    PROGRESS_STEPS times and a block holds at most SPARSE_ROWS rows.
+    :param n_rows: number of rows to be computed
+    :return: number of rows per block, at least one
+    """
+    return max(1, min(SPARSE_ROWS, -(-n_rows // PROGRESS_STEPS)))
+
+
+def sweepWeights(location, bandwidths, weightmethod, tolerance=None, dtype=float,
+                 progress=None):
+    """
+    Build the sparse weight matrices of several bandwidths, neighbours being
+    searched a single time for the largest radius. Rows are built by blocks
+    against one KD-tree of all the locations.
+    :param location: 2d array with x and y coordinates of all tracts
+    :param bandwidths: list of bandwidths for neighborhood in meters
+    :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+    :param tolerance: relative weight tolerance to truncate the gaussian
+    :param dtype: floating point type of the weights
+    :param progress: optional callable receiving the rows done and the total
+        after each block, it may raise an exception to stop the computation
+    :return: list of n x n scipy CSR weight matrices, one by bandwidth
+    """
+    from scipy.sparse import vstack
+    from scipy.spatial import cKDTree
+
+    location = np.asarray(location, dtype=float)
+    n_local = location.shape[0]
+    radius = max([neighbourRadius(bw, weightmethod, tolerance) for bw in bandwidths])
+    tree = cKDTree(location)
+    blocks = [[] for bw in bandwidths]
+    block = sparseBlock(n_local)
+    for first in range(0, n_local, block):
+        last = min(first + block, n_local)
+        distance = neighbourDistances(location, radius, first, last, tree)
+        for rows, bandwidth in zip(blocks, bandwidths):
+            rows.append(sparseWeights(distance, bandwidth, weightmethod, tolerance, dtype))
+        if progress is not None:
+            progress(last, n_local)
+    return [vstack(rows, format='csr') for rows in blocks]
+
+
+def localityWeights(weight, pop, dropped=None):
+    """
+    Apply a sparse weight matrix to all group columns at once. Products and
+    row sums are accumulated in double whatever the type of the weights.
+    :param weight: scipy CSR matrix with the weights of some rows against all tracts
+    :param pop: 2d array like with the population of each group by tract
+    :param dropped: 1d array bounding the weight the kernel truncation dropped
+        on each row, see droppedWeight, None if the weights are exact
+    :return: tuple with the 2d intensity array of the rows and the maximum
+        error introduced by truncation
+    """
+    pop = np.asarray(pop, dtype=float)
+    kept = weight.dot(np.ones(weight.shape[1]))
+    locality = weight.dot(pop) / kept[:, None]
+
+    error = 0.0
+    if dropped is not None:
+        error = truncationBound(dropped, kept, pop, locality)
+
+    # assign zero to negative values
+    locality[locality < 0] = 0
+    return locality, error
+
+
+def selectEngine(weightmethod, engine='auto', tolerance=None, location=None):
+    """
+    Resolve the auto engine: fft if the locations are given and form a regular
+    lattice, otherwise sparse whenever the kernel is compact or truncated and
+    dense for the full gaussian.
+    :return: 'dense', 'sparse' or 'fft'
+    """
+    if engine == 'auto':
+        if location is not None and regularLattice(location) is not None:
+            return 'fft'
+        sparse = weightmethod in (2, 3) or tolerance is not None
+        engine = 'sparse' if sparse else 'dense'
+    return engine
+
+
+def localityRows(location, pop, start, stop, bandwidths, weightmethod, memory=None,
+                 engine='dense', tolerance=None, out=None, dtype=float, progress=None):
+    """
+    Compute the population intensity of the rows start:stop against all the
+    locations with the given engine, for one or more bandwidths. Distances, or
+    the neighbour lists of the largest bandwidth, are computed once and every
+    kernel is evaluated from them.
+    :param location: 2d array with x and y coordinates of all tracts
+    :param pop: 2d array with the population of each group by tract
+    :param start: first row to be computed
+    :param stop: row after the last one to be computed
+    :param bandwidths: list of bandwidths for neighborhood in meters
+    :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+    :param memory: memory budget in megabytes for the dense weight blocks
+    :param engine: 'dense' or 'sparse'
+    :param tolerance: relative weight tolerance to truncate the gaussian
+    :param out: optional 3d array (bandwidth, row, group) to be filled
+    :param dtype: floating point type of weights and intensity
+    :param progress: optional callable receiving the rows done and the total
+        after each block, it may raise an exception to stop the computation
+    :return: tuple with a 3d array (bandwidth, row, group) with the intensity
+        of the rows and an array with the maximum truncation error by bandwidth
+    """
+    locality = out
+    if locality is None:
+        locality = np.empty([len(bandwidths), stop - start, pop.shape[1]], dtype=dtype)
+    error = np.zeros(len(bandwidths))
+
+    if engine == 'sparse':
+        from scipy.spatial import cKDTree
+        radius = max([neighbourRadius(bw, weightmethod, tolerance) for bw in bandwidths])
+        truncation = tolerance if weightmethod == 1 else None
+        reach = [None] * len(bandwidths)
+        if truncation is not None:
+            reach = [droppedBound(location, bw, truncation, 0, start, stop) for bw in bandwidths]
+        tree = cKDTree(location)
+        block = sparseBlock(stop - start)
+        for first in range(start, stop, block):
+            last = min(first + block, stop)
+            distance = neighbourDistances(location, radius, first, last, tree)
+            for index, bandwidth in enumerate(bandwidths):
+                weight = sparseWeights(distance, bandwidth, weightmethod, tolerance, dtype)
+                dropped = None
+                if truncation is not None:
+                    dropped = droppedWeight(location, weight, bandwidth, truncation, first,
+                                            reach[index][first - start:last - start])
+                rows = slice(first - start, last - start)
+                locality[index, rows], block_error = localityWeights(weight, pop, dropped)
+                error[index] = max(error[index], block_error)
+            if progress is not None:
+                progress(last - start, stop - start)
+
+    elif engine == 'dense':
+        from scipy.spatial.distance import cdist
+        pop = np.asarray(pop, dtype=dtype)
+        block = blockSize(location.shape[0], memory, np.dtype(dtype).itemsize)
+        for first in range(start, stop, block):
+            last = min(first + block, stop)
+            distance = cdist(location[first:last], location).astype(dtype, copy=False)
+            for index, bandwidth in enumerate(bandwidths):
+                locality[index, first - start:last - start] = localityBlock(distance, pop,
+                                                                            bandwidth,
+                                                                            weightmethod)
+            if progress is not None:
+                progress(last - start, stop - start)
+
+    else:
+        raise Exception('Invalid intensity engine selected!')
+
+    return locality, error
+
+
+def _pythonExecutable():
+    """
+    Start the processes of the next pools with the python interpreter on
+    windows, where the executable of the process is QGIS in the plugin.
+    :return: executable to restore once the pool is done, None if unchanged
+    """
+    if os.name != 'nt':
+        return None
+
+    try:
+        from multiprocessing.spawn import get_executable
+        previous = get_executable()
+    except ImportError:  # python 2
+        from multiprocessing import forking
+        previous = forking._python_exe
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+    return previous
+
+
+def _sharedArray(array):
+    """Copy an array of floats to shared memory, return the buffer, shape and type"""
+    typecode = 'f' if array.dtype == np.float32 else 'd'
+    buffer = RawArray(typecode, int(array.size))
+    np.frombuffer(buffer, dtype=array.dtype).reshape(array.shape)[:] = array
+    return buffer, array.shape, array.dtype.str
+
+
+def _attachArray(shared):
+    """Numpy view of a shared buffer, or of a memory-mapped file given by its name"""
+    if isinstance(shared[0], (str, type(u''))):
+        return np.memmap(shared[0], dtype=shared[2], mode='r+', shape=shared[1])
+    return np.frombuffer(shared[0], dtype=shared[2]).reshape(shared[1])
+
+
+def _initWorker(location, pop, locality, parameters):
+    """Attach the shared arrays and the intensity parameters to a worker process"""
+    _worker['location'] = _attachArray(location)
+    _worker['pop'] = _attachArray(pop)
+    _worker['locality'] = _attachArray(locality)
+    _worker['parameters'] = parameters
+
+
+def _localityWorker(rows):
+    """Fill the shared intensity rows start:stop, return the truncation errors"""
+    start, stop = rows
+    locality, error = localityRows(_worker['location'], _worker['pop'], start, stop,
+                                   **_worker['parameters'])
+    _worker['locality'][:, start:stop] = locality
+    if isinstance(_worker['locality'], np.memmap):
+        _worker['locality'].flush()
+    return error
+
+
+def localityParallel(location, pop, bandwidths, weightmethod, memory=None, engine='dense',
+                     tolerance=None, workers=2, out=None, dtype=float, progress=None):
+    """
+    Compute the population intensity on a pool of processes. Location and
+    population are placed in shared memory instead of being pickled, and each
+    worker fills a slice of rows of the shared intensity array. The memory
+    budget is split between the workers. If out is memory-mapped the workers
+    write straight to its file.
+    :param location: 2d array with x and y coordinates of all tracts
+    :param pop: 2d array with the population of each group by tract
+    :param bandwidths: list of bandwidths for neighborhood in meters
+    :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+    :param memory: memory budget in megabytes for the dense weight blocks
+    :param engine: 'dense' or 'sparse'
+    :param tolerance: relative weight tolerance to truncate the gaussian
+    :param workers: number of worker processes
+    :param out: optional 3d array (bandwidth, tract, group) to be filled
+    :param dtype: floating point type of weights and intensity
+    :param progress: optional callable receiving the rows done and the total
+        as slices complete, it may raise an exception to stop the pool
+    :return: tuple with the 3d intensity array (bandwidth, tract, group) and
+        the maximum truncation error by bandwidth
+    """
+    n_local = location.shape[0]
+    if memory is not None:
+        memory = float(memory) / workers
+    parameters = {'bandwidths': list(bandwidths), 'weightmethod': weightmethod,
+                  'memory': memory, 'engine': engine, 'tolerance': tolerance,
+                  'dtype': np.dtype(dtype).str}
+
+    # a few slices per worker to balance uneven neighbourhoods
+    bounds = np.linspace(0, n_local, min(n_local, 4 * workers) + 1).astype(int)
+    rows = [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    if isinstance(out, np.memmap):
+        out.flush()
+        shared = (out.filename, out.shape, out.dtype.str)
+    else:
+        shared = _sharedArray(np.empty([len(bandwidths), n_local, pop.shape[1]], dtype=dtype))
+
+    executable = _pythonExecutable()
+    try:
+        pool = multiprocessing.Pool(workers, _initWorker, (_sharedArray(location),
+                                                           _sharedArray(pop), shared, parameters))
+        try:
+            errors = []
+            for (start, stop), error in zip(rows, pool.imap(_localityWorker, rows)):
+                errors.append(error)
+                if progress is not None:
+                    progress(stop, n_local)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        if executable is not None:
+            multiprocessing.set_executable(executable)
+
+    if isinstance(out, np.memmap):
+        return out, np.max(errors, axis=0)
+
+    locality = _attachArray(shared)
+    if out is None:
+        return locality.copy(), np.max(errors, axis=0)
+    out[:] = locality
+    return out, np.max(errors, axis=0)
+
+
+def localitySweep(location, pop, bandwidths, weightmethod, memory=None, engine='auto',
+                  tolerance=None, workers=1, out=None, dtype=float, progress=None):
+    """
+    Compute the local population intensity for all groups and several
+    bandwidths in one pass. Each weight row is built from distances computed a
+    single time and applied to every group column in one matrix product, the
+    row sums of the weights being the common denominator. Results match the
+    per location and per group loop up to floating point summation order.
+    If a memory budget is given, rows are processed in blocks against all the
+    locations so peak memory is bounded by block x n instead of n x n.
+    The sparse engine keeps only the neighbours within the bandwidth, which
+    is exact for the bi-square and moving window kernels. With a tolerance the
+    gaussian is truncated and can use the sparse engine too, the error bound
+    from truncationBound being returned. The fft engine convolves the kernel
+    with the population on the cells of a regular lattice, see LatticeOperator.
+    The auto engine selects fft when the locations form a lattice, else the
+    sparse engine whenever the kernel is compact or truncated, dense otherwise.
+    With more than one worker the rows are split over a process pool. For
+    out-of-core runs out may be a memory-mapped array from scratchArray, the
+    distance blocks being bounded by the memory budget instead. In single
+    precision weights and intensity are float32 while sums are accumulated in
+    double.
+    :param location: 2d array like with x and y coordinates of each tract
+    :param pop: 2d array like with the population of each group by tract
+    :param bandwidths: list of bandwidths for neighborhood in meters
+    :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+    :param memory: memory budget in megabytes for the weight blocks, None for
+        the whole matrix at once
+    :param engine: one of ENGINES, 'auto', 'dense', 'sparse' or 'fft'
+    :param tolerance: relative weight tolerance to truncate the gaussian, None
+        keeps the full kernel
+    :param workers: number of processes, 1 computes on the calling process
+    :param out: optional 3d array (bandwidth, tract, group) to be filled
+    :param dtype: one of PRECISIONS, floating point type of weights and intensity
+    :param progress: optional callable receiving the work done and the total
+        as the computation advances, it may raise an exception to stop it
+    :return: tuple with the 3d array (bandwidth, tract, group) of population
+        intensity and the maximum error introduced by truncation for each
+        bandwidth (0.0 if exact)
+    """
+    location = np.asarray(location, dtype=float)
+    pop = np.asarray(pop, dtype=float)
+    n_local = location.shape[0]
+
+    engine = selectEngine(weightmethod, engine, tolerance, location)
+    if engine == 'fft':
+        locality = out
+        if locality is None:
+            locality = np.empty([len(bandwidths), n_local, pop.shape[1]], dtype=dtype)
+        error = np.zeros(len(bandwidths))
+        lattice = regularLattice(location)
+        for index, bandwidth in enumerate(bandwidths):
+            operator = LatticeOperator(location, bandwidth, weightmethod, tolerance, memory,
+                                       lattice)
+            locality[index], error[index] = operator.apply(pop)
+            if progress is not None:
+                progress(index + 1, len(bandwidths))
+        return locality, error
+
+    if workers > 1 and n_local > 1:
+        locality, error = localityParallel(location, pop, bandwidths, weightmethod, memory,
+                                           engine, tolerance, workers, out, dtype,
+                                           progress)
+    else:
+        locality, error = localityRows(location, pop, 0, n_local, bandwidths, weightmethod,
+                                       memory, engine, tolerance, out, dtype,
+                                       progress)
+
+    # assign zero to negative values
+    locality[locality < 0] = 0
+    return locality, error
+
+
+def localityMatrix(location, pop, bandwidth, weightmethod, memory=None, engine='auto',
+                   tolerance=None, workers=1, dtype=float):
+    """
+    Compute the local population intensity for all groups and one bandwidth,
+    see localitySweep for the engines and parameters.
+    :param bandwidth: bandwidth for neighborhood in meters
+    :return: tuple with the 2d array of population intensity for all groups
+        and the maximum error introduced by truncation (0.0 if exact)
+    """
+    locality, error = localitySweep(location, pop, [bandwidth], weightmethod, memory, engine,
+                                    tolerance, workers, dtype=dtype)
+    return locality[0], float(error[0])
+
+
+class WeightOperator(object):
+    def __init__(self, weight, dropped=None, memory=None):
+        """
+        Spatial weights of a layer for one kernel and bandwidth, kept so the
+        intensity of any set of population columns is a single product.
+        :param weight: scipy CSR matrix or dense 2d array (may be memory-mapped)
+            with the weights of every tract against all the tracts
+        :param dropped: 1d array bounding the weight a truncated gaussian
+            dropped on each row, see droppedWeight, None if the weights are exact
+        :param memory: memory budget in megabytes for the dense products
+        """
+        self.weight = weight
+        self.dropped = dropped
+        self.memory = memory
+        self.dense = isinstance(weight, np.ndarray)
+
+    @classmethod
+    def sparse(cls, location, bandwidths, weightmethod, tolerance=None, dtype=float,
+               progress=None):
+        """
+        Build the sparse operators of several bandwidths, neighbours being
+        searched a single time. See sweepWeights.
+        :return: list of WeightOperator, one by bandwidth
+        """
+        truncation = tolerance if weightmethod == 1 else None
+        weights = sweepWeights(location, bandwidths, weightmethod, tolerance, dtype, progress)
+        return [cls(weight, droppedWeight(location, weight, bandwidth, truncation))
+                for weight, bandwidth in zip(weights, bandwidths)]
+
+    @classmethod
+    def full(cls, location, bandwidths, weightmethod, memory=None, scratch=None, dtype=float,
+             progress=None):
+        """
+        Build the dense n x n operators of several bandwidths, distances being
+        computed once by blocks of rows within the memory budget.
+        :param location: 2d array with x and y coordinates of all tracts
+        :param bandwidths: list of bandwidths for neighborhood in meters
+        :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+        :param memory: memory budget in megabytes for the distance blocks
+        :param scratch: directory to memory-map the weight matrices
+        :param dtype: floating point type of the weights
+        :param progress: optional callable receiving the rows done and the total
+        :return: list of WeightOperator, one by bandwidth
+        """
+        from scipy.spatial.distance import cdist
+        location = np.asarray(location, dtype=float)
+        n_local = location.shape[0]
+        weights = [scratchArray([n_local, n_local], scratch, dtype) for bw in bandwidths]
+
+        block = blockSize(n_local, memory, np.dtype(dtype).itemsize)
+        for first in range(0, n_local, block):
+            last = min(first + block, n_local)
+            distance = cdist(location[first:last], location).astype(dtype, copy=False)
+            for weight, bandwidth in zip(weights, bandwidths):
+                weight[first:last] = kernelWeight(distance, bandwidth, weightmethod)
+            if progress is not None:
+                progress(last, n_local)
+
+        return [cls(weight, memory=memory) for weight in weights]
+
+    @staticmethod
+    def fullSize(n_location, dtype=float):
+        """Size in megabytes of a dense operator"""
+        return float(n_location) * n_location * np.dtype(dtype).itemsize / (1024 * 1024)
+
+    @staticmethod
+    def rowSize(n_location, dtype=float):
+        """Size in megabytes of one row of distances and kernel temporaries, see blockSize"""
+        return float(n_location) * (8 + 3 * np.dtype(dtype).itemsize) / (1024 * 1024)
+
+    def apply(self, pop):
+        """
+        Population intensity of the given columns.
+        :param pop: 2d array like with the population of each group by tract
+        :return: tuple with the 2d intensity array and the maximum error
+            introduced by truncation (0.0 if exact)
+        """
+        if not self.dense:
+            return localityWeights(self.weight, pop, self.dropped)
+
+        n_local = self.weight.shape[0]
+        pop = np.asarray(pop, dtype=self.weight.dtype)
+        locality = np.empty([n_local, pop.shape[1]])
+        block = blockSize(n_local, self.memory, self.weight.dtype.itemsize)
+        for first in range(0, n_local, block):
+            weight = self.weight[first:first + block]
+            rowsum = np.sum(weight, axis=1, dtype=np.float64)
+            locality[first:first + block] = weightProduct(weight, pop) / rowsum[:, None]
+
+        # assign zero to negative values
+        locality[locality < 0] = 0
+        return locality, 0.0
+
+
+def latticeAxis(values):
+    """
+    Match coordinates on one axis to the nodes of a regular spacing.
+    :param values: 1d array with the coordinates
+    :return: tuple with the origin, the spacing and the integer node of each
+        value, or None if the values are not regularly spaced
+    """
+    unique = np.unique(values)
+    span = unique[-1] - unique[0]
+    if span == 0:
+        return unique[0], 1.0, np.zeros(len(values), dtype=int)
+
+    steps = np.diff(unique)
+    step = steps[steps > 1e-9 * span].min()
+    node = np.round((values - unique[0]) / step)
+    if np.max(np.abs(values - unique[0] - node * step)) > 1e-3 * step:
+        return None
+    return unique[0], step, node.astype(int)
+
+
+def regularLattice(location):
+    """
+    Detect if the locations are the centres of a regular grid of cells aligned
+    with the axes, as centroids of square or rectangular cell polygons. Cells
+    may be missing, but at most one location falls on each cell and the grid
+    has no more than LATTICE_FILL cells per location.
+    :param location: 2d array like with x and y coordinates of each tract
+    :return: tuple with the (dy, dx) spacing, the row and column of each
+        location and the (rows, columns) shape of the grid, or None
+    """
+    location = np.asarray(location, dtype=float)
+    if location.shape[0] < 2:
+        return None
+
+    x_axis = latticeAxis(location[:, 0])
+    y_axis = latticeAxis(location[:, 1])
+    if x_axis is None or y_axis is None:
+        return None
+
+    rows, cols = y_axis[2], x_axis[2]
+    shape = (int(rows.max()) + 1, int(cols.max()) + 1)
+    if shape[0] * shape[1] > LATTICE_FILL * location.shape[0]:
+        return None
+    if len(np.unique(rows * shape[1] + cols)) != location.shape[0]:
+        return None
+    return (y_axis[1], x_axis[1]), rows, cols, shape
+
+
+def fastLength(size):
+    """Smallest length not below size with no prime factor above 5, fast for the FFT"""
+    best = 2 * size
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            length = power35
+            while length < size:
+                length *= 2
+            best = min(best, length)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+
+class LatticeOperator(object):
+    def __init__(self, location, bandwidth, weightmethod, tolerance=None, memory=None,
+                 lattice=None):
+        """
+        Weights of a kernel on a regular lattice, applied by FFT convolution so
+        the intensity of a grid of n cells costs O(n log n). The grid is zero
+        padded by the kernel extent so nothing wraps around its edges, and the
+        kernel sum of each cell is the convolution of the kernel with the
+        occupied cells. Edges and empty cells are thus normalized as in the
+        dense and sparse engines, results matching them up to rounding. The
+        full gaussian spans the whole grid, a tolerance truncates it.
+        :param location: 2d array with x and y coordinates of all tracts
+        :param bandwidth: bandwidth for neighborhood in meters
+        :param weightmethod: 1 for gaussian, 2 for bi-square and 3 for moving window
+        :param tolerance: relative weight tolerance to truncate the gaussian
+        :param memory: memory budget in megabytes, groups are convolved in
+            chunks that fit on it
+        :param lattice: result of regularLattice, detected if not given
+        """
+        if lattice is None:
+            lattice = regularLattice(location)
+        if lattice is None:
+            raise Exception('Centroids are not a regular lattice, FFT engine not available!')
+
+        (dy, dx), self.rows, self.cols, self.shape = lattice
+        self.memory = memory
+        self.tolerance = tolerance if weightmethod == 1 else None
+
+        # kernel on the cell offsets within its radius
+        height, width = self.shape
+        if self.tolerance is None and weightmethod == 1:
+            radius = np.inf
+        else:
+            radius = neighbourRadius(bandwidth, weightmethod, self.tolerance)
+        self.reach = (int(min(height - 1, np.floor(radius / dy))),
+                      int(min(width - 1, np.floor(radius / dx))))
+        offset_y = np.arange(-self.reach[0], self.reach[0] + 1) * dy
+        offset_x = np.arange(-self.reach[1], self.reach[1] + 1) * dx
+        distance = np.hypot(offset_y[:, None], offset_x[None, :])
+        kernel = kernelWeight(distance, bandwidth, weightmethod)
+        kernel[distance > radius] = 0
+
+        self.fftShape = (fastLength(height + 2 * self.reach[0]),
+                         fastLength(width + 2 * self.reach[1]))
+        self.kernel = np.fft.rfft2(kernel, self.fftShape)
+
+        # kernel sum and, for a truncated gaussian, weight dropped by cell
+        occupied = self.grid(np.ones([len(self.rows), 1]))
+        self.kept = self.convolve(occupied)[self.rows, self.cols, 0]
+        self.dropped = None
+        if self.tolerance is not None:
+            support = np.fft.rfft2((kernel > 0).astype(float), self.fftShape)
+            count = np.round(self.convolve(occupied, support)[self.rows, self.cols, 0])
+            self.dropped = droppedBound(location, bandwidth, self.tolerance, count)
+
+    def grid(self, values):
+        """Scatter the columns of values by location to a (rows, columns, k) grid"""
+        grid = np.zeros(self.shape + (values.shape[1],))
+        grid[self.rows, self.cols] = values
+        return grid
+
+    def convolve(self, grid, kernel=None):
+        """Linear convolution of each layer of a grid with a kernel spectrum"""
+        if kernel is None:
+            kernel = self.kernel
+        spectrum = np.fft.rfft2(grid, self.fftShape, axes=(0, 1)) * kernel[:, :, None]
+        full = np.fft.irfft2(spectrum, self.fftShape, axes=(0, 1))
+        return full[self.reach[0]:self.reach[0] + self.shape[0],
+                    self.reach[1]:self.reach[1] + self.shape[1]]
+
+    def apply(self, pop):
+        """
+        Population intensity of the given columns, see WeightOperator.apply.
+        :param pop: 2d array like with the population of each group by tract
+        :return: tuple with the 2d intensity array and the maximum error
+            introduced by truncation (0.0 if exact)
+        """
+        pop = np.asarray(pop, dtype=float)
+        locality = np.empty(pop.shape)
+
+        # a group takes a padded real layer and its complex spectrum
+        chunk = pop.shape[1]
+        if self.memory is not None:
+            layer = self.fftShape[0] * self.fftShape[1] * 3 * 8
+            chunk = max(1, int(self.memory * 1024 * 1024 // layer))
+        for first in range(0, pop.shape[1], chunk):
+            weighted = self.convolve(self.grid(pop[:, first:first + chunk]))
+            locality[:, first:first + chunk] = (weighted[self.rows, self.cols] /
+                                                self.kept[:, None])
+
+        error = 0.0
+        if self.dropped is not None:
+            error = truncationBound(self.dropped, self.kept, pop, locality)
+
+        # assign zero to negative values
+        locality[locality < 0] = 0
+        return locality, error
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Local and global segregation measures. Only numpy is used here, so the
+ measures can be computed without a QGIS session. Local measures take the
+ population intensity for the spatial version or an empty locality for the
+ non spatial version (raw data), rows being processed in blocks within a
+ memory budget so a memory-mapped intensity is streamed instead of loaded.
+ measureSet computes several measures at once, the local ones sharing a
+ single pass over the rows.
+"""
+import numpy as np
+
+from segreg_intensity import blockSize, scratchArray
+
+# measures in the order they are computed, with the measures each one needs
+MEASURES = ['local_dissimilarity', 'global_dissimilarity', 'local_exposure', 'global_exposure',
+            'local_entropy', 'global_entropy', 'local_indexh', 'global_indexh']
+DEPENDENCIES = {'local_dissimilarity': [],
+                'global_dissimilarity': ['local_dissimilarity'],
+                'local_exposure': [],
+                'global_exposure': [],
+                'local_entropy': [],
+                'global_entropy': [],
+                'local_indexh': ['local_entropy', 'global_entropy'],
+                'global_indexh': ['local_indexh']}
+
+# measures computed on the pass over the rows
+ROW_MEASURES = ['local_dissimilarity', 'local_exposure', 'global_exposure', 'local_entropy']
+
+
+def isSpatial(locality):
+    """True if a population intensity was given, False for the raw data version"""
+    return locality is not None and len(locality) != 0
+
+
+def exposurePairs(n_group):
+    """All the group pairs, in the column order of the local exposure"""
+    return [(i, j) for i in range(n_group) for j in range(n_group)]
+
+
+def measurePlan(measures):
+    """
+    Measures to compute for the requested ones and the ones they depend on,
+    each measure once and after its dependencies.
+    :param measures: list of names from MEASURES
+    :return: list of names in MEASURES order
+    """
+    needed = set()
+    pending = list(measures)
+    while pending:
+        name = pending.pop()
+        if name not in DEPENDENCIES:
+            raise Exception('Unknown measure %s!' % name)
+        if name not in needed:
+            needed.add(name)
+            pending.extend(DEPENDENCIES[name])
+    return [name for name in MEASURES if name in needed]
+
+
+def measureRows(pop, locality, measures, memory=None, dtype=float, scratch=None, progress=None,
+                pairs=None):
+    """
+    Compute the local measures and the global exposure in one pass over
+    blocks of rows. Column totals and group shares are computed once, and
+    the group proportions of each block (source over its row total) are
+    shared by dissimilarity, exposure and entropy.
+    :param measures: list of names from ROW_MEASURES
+    :return: dictionary with the measures by name
+    """
+    pop = np.asarray(pop)
+    n_location, n_group = pop.shape
+    if pairs is None:
+        pairs = exposurePairs(n_group)
+
+    # terms of the population shared by the measures
+    group_total = np.sum(pop, axis=0)
+    pop_total = np.sum(pop)
+    pop_sum = np.sum(pop, axis=1).astype(dtype)
+    if 'local_exposure' in measures or 'global_exposure' in measures:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = pop * 1.0 / group_total
+
+    results = {}
+    width = n_group
+    if 'local_dissimilarity' in measures:
+        tm = group_total * 1.0 / pop_total
+        index_i = np.sum(np.asarray(tm) * np.asarray(1 - tm))
+        tm = np.asarray(tm, dtype=dtype)
+        local_diss = np.empty(n_location)
+    if 'local_exposure' in measures:
+        local_expo = share.astype(dtype)
+        exposure_rs = scratchArray((n_location, len(pairs)), scratch, dtype)
+        width += len(pairs)
+    if 'global_exposure' in measures:
+        # empty groups and tracts without population are ignored
+        global_share = np.where(np.isfinite(share), share, 0)
+        global_exp = np.zeros((n_group, n_group))
+    if 'local_entropy' in measures:
+        entropy = np.empty((n_location, 1))
+        width += n_group
+
+    block = blockSize(width, memory)
+    for start in range(0, n_location, block):
+        stop = min(start + block, n_location)
+
+        # non-spatial version uses raw data, spatial version population intensity
+        if not isSpatial(locality):
+            source = np.asarray(pop[start:stop], dtype=dtype)
+        else:
+            source = np.asarray(locality[start:stop], dtype=dtype)
+
+        # proportion of each group in the row, shared by the measures
+        source_sum = np.sum(source, axis=1, dtype=np.float64).astype(dtype)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            proportion = source * 1.0 / source_sum[:, None]
+
+        if 'local_dissimilarity' in measures:
+            local_diss[start:stop] = np.sum(1.0 * np.array(np.fabs(proportion - tm)) *
+                                            pop_sum[start:stop, None] / (2 * pop_total * index_i),
+                                            axis=1, dtype=np.float64)
+
+        if 'local_exposure' in measures:
+            exposure = np.empty((stop - start, len(pairs)), dtype=dtype)
+            for column, (group_i, group_j) in enumerate(pairs):
+                exposure[:, column] = proportion[:, group_j] * local_expo[start:stop, group_i]
+
+            # clear nan and inf values
+            exposure[np.isinf(exposure)] = 0
+            exposure[np.isnan(exposure)] = 0
+            exposure_rs[start:stop] = exposure
+
+        if 'global_exposure' in measures:
+            rate = np.where(np.isfinite(proportion), proportion, 0)
+            global_exp += np.dot(global_share[start:stop].T, rate)
+
+        if 'local_entropy' in measures:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                block_entropy = proportion * np.log(1 / proportion)
+
+            # clear nan and inf values and sum line
+            block_entropy[np.isnan(block_entropy)] = 0
+            block_entropy[np.isinf(block_entropy)] = 0
+            entropy[start:stop, 0] = np.sum(block_entropy, axis=1, dtype=np.float64)
+
+        if progress is not None:
+            progress(stop, n_location)
+
+    # clear nan values and transpose matrix
+    if 'local_dissimilarity' in measures:
+        results['local_dissimilarity'] = np.asmatrix(np.nan_to_num(local_diss)).transpose()
+    # convert to matrix, a view when memory-mapped
+    if 'local_exposure' in measures:
+        results['local_exposure'] = np.asmatrix(exposure_rs)
+    if 'global_exposure' in measures:
+        results['global_exposure'] = np.asmatrix(global_exp)
+    if 'local_entropy' in measures:
+        results['local_entropy'] = entropy
+    return results
+
+
+def measureSet(pop, locality=None, measures=MEASURES, memory=None, dtype=float, scratch=None,
+               progress=None, pairs=None):
+    """
+    Compute several measures, each one at most once. Local measures needed
+    are computed together on one pass over the rows, see measureRows, and
+    the other ones are derived from them.
+    :param pop: 2d array like with the population of each group by tract
+    :param locality: 2d array like with the population intensity, empty or
+        None for the non spatial version
+    :param measures: list of names from MEASURES
+    :param memory: memory budget in megabytes for the row blocks
+    :param dtype: floating point type of the local measures
+    :param scratch: directory to memory-map the local exposure, None for memory
+    :param progress: optional callable receiving the rows done and the total
+    :param pairs: list of (i, j) group pairs of the local exposure, None for all
+    :return: dictionary with the measures of the plan by name, see measurePlan
+    """
+    plan = measurePlan(measures)
+    rows = [name for name in plan if name in ROW_MEASURES]
+    results = {}
+    if rows:
+        results = measureRows(pop, locality, rows, memory, dtype, scratch, progress, pairs)
+
+    if 'global_dissimilarity' in plan:
+        results['global_dissimilarity'] = globalDissimilarity(results['local_dissimilarity'])
+    if 'global_entropy' in plan:
+        results['global_entropy'] = globalEntropy(pop)
+    if 'local_indexh' in plan:
+        results['local_indexh'] = localIndexH(pop, results['local_entropy'],
+                                              results['global_entropy'])
+    if 'global_indexh' in plan:
+        results['global_indexh'] = globalIndexH(results['local_indexh'])
+    return results
+
+
+def localDissimilarity(pop, locality=None, memory=None, dtype=float, progress=None):
+    """
+    Compute local dissimilarity for all groups. Elementwise terms use the
+    given precision and row sums are taken in double.
+    :param pop: 2d array like with the population of each group by tract
+    :param locality: 2d array like with the population intensity, empty or
+        None for the non spatial version
+    :param memory: memory budget in megabytes for the row blocks
+    :param dtype: floating point type of the elementwise terms
+    :param progress: optional callable receiving the rows done and the total
+    :return: n x 1 matrix with the local dissimilarity
+    """
+    return measureRows(pop, locality, ['local_dissimilarity'], memory, dtype,
+                       progress=progress)['local_dissimilarity']
+
+
+def globalDissimilarity(local_diss):
+    """
+    Compute global dissimilarity summing up the local version.
+    :param local_diss: result of localDissimilarity
+    :return: global dissimilarity
+    """
+    return np.sum(local_diss)
+
+
+def localExposure(pop, locality=None, memory=None, dtype=float, scratch=None, progress=None,
+                  pairs=None):
+    """
+    Compute the local exposure index of group m to group n.
+    in situations where m=n, then the result is the isolation index.
+    Only the given group pairs are stored, in the given precision, row sums
+    being taken in double.
+    :param pop: 2d array like with the population of each group by tract
+    :param locality: 2d array like with the population intensity, empty or
+        None for the non spatial version
+    :param memory: memory budget in megabytes for the row blocks
+    :param dtype: floating point type of the result
+    :param scratch: directory to memory-map the result, None for memory
+    :param progress: optional callable receiving the rows done and the total
+    :param pairs: list of (i, j) group pairs, None for all of them as given
+        by exposurePairs
+    :return: n x len(pairs) matrix, column k holding exposure of group
+        pairs[k][0] to group pairs[k][1]
+    """
+    return measureRows(pop, locality, ['local_exposure'], memory, dtype, scratch, progress,
+                       pairs)['local_exposure']
+
+
+def globalExposure(pop, locality=None, memory=None, progress=None):
+    """
+    Compute global exposure, the sum of the local version over the tracts,
+    as the product of the group shares by the local group rates. Rows are
+    taken by blocks and the n x m^2 local exposure is never built.
+    :param pop: 2d array like with the population of each group by tract
+    :param locality: 2d array like with the population intensity, empty or
+        None for the non spatial version
+    :param memory: memory budget in megabytes for the row blocks
+    :param progress: optional callable receiving the rows done and the total
+    :return: m x m matrix with the global exposure of group i to group j
+    """
+    return measureRows(pop, locality, ['global_exposure'], memory,
+                       progress=progress)['global_exposure']
+
+
+def localEntropy(pop, locality=None, memory=None, dtype=float, progress=None):
+    """
+    Compute local entropy score for a unit area Ei (diversity). A unit
+    within the metropolitan area, such as a census tract. Proportions use the
+    given precision and row sums are taken in double.
+    :param pop: 2d array like with the population of each group by tract
+    :param locality: 2d array like with the population intensity, empty or
+        None for the non spatial version
+    :param memory: memory budget in megabytes for the row blocks
+    :param dtype: floating point type of the proportions
+    :param progress: optional callable receiving the rows done and the total
+    :return: n x 1 array with the local entropy
+    """
+    return measureRows(pop, locality, ['local_entropy'], memory, dtype,
+                       progress=progress)['local_entropy']
+
+
+def globalEntropy(pop):
+    """
+    Compute the global entropy score E (diversity), metropolitan area's entropy score.
+    :param pop: 2d array like with the population of each group by tract
+    :return: global entropy
+    """
+    pop = np.asarray(pop)
+    group_score = []
+    pop_total = np.sum(np.sum(pop, axis=1))
+    prop = np.sum(pop, axis=0)
+
+    # loop at sum of each population groups
+    for group in prop:
+        group_idx = group / pop_total * np.log(1 / (group / pop_total))
+        group_score.append(group_idx)
+
+    # sum scores from each group to get the result
+    return np.sum(group_score)
+
+
+def localIndexH(pop, local_entropy, global_entropy):
+    """
+    Computes the local entropy index H for all localities from the local
+    diversity and the global entropy.
+    :param pop: 2d array like with the population of each group by tract
+    :param local_entropy: result of localEntropy
+    :param global_entropy: result of globalEntropy
+    :return: n x 1 array with the local index H
+    """
+    pop_sum = np.sum(np.asarray(pop), axis=1)[:, None]
+
+    # compute index
+    et = np.asarray(global_entropy * np.sum(pop_sum))
+    eei = np.asarray(global_entropy - local_entropy)
+    return pop_sum * eei / et
+
+
+def globalIndexH(h_local):
+    """
+    Compute global index H summing up the local version.
+    :param h_local: result of localIndexH
+    :return: 1 element array with the global index H
+    """
+    return np.sum(h_local, axis=0)
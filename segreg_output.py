@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Result table and file output of the measures, without QGIS dependencies.
+"""
+import gzip
+
+import numpy as np
+
+from segreg_measures import exposurePairs
+
+# pyarrow module once imported by arrowModule, it is slow to import and
+# only needed by the columnar formats
+_arrow = {}
+
+# output formats of the local results as extension and description, the
+# GeoPackage is written by the plugin through QGIS
+FORMATS = [('csv', 'CSV'),
+           ('csv.gz', 'CSV gzip'),
+           ('npz', 'NumPy compressed'),
+           ('gpkg', 'GeoPackage'),
+           ('parquet', 'Parquet'),
+           ('arrow', 'Arrow IPC')]
+
+
+class ResultTable(object):
+    def __init__(self, tract_id, names, columns, year=None):
+        """
+        Constructor. Local results as typed columns, the ids kept apart from
+        the numeric columns. Columns are usually views on the arrays they come
+        from, so a memory-mapped measure stays on disk until it is written.
+        :param tract_id: array like with the id of each tract
+        :param names: list with the names of the numeric columns
+        :param columns: list of 1d arrays, one by name
+        :param year: optional array like with the year of each row, for the
+            long format results of a panel, written before the id
+        """
+        self.ids = np.asarray(tract_id).ravel()
+        self.names = list(names)
+        self.columns = list(columns)
+        self.years = None
+        if year is not None:
+            self.years = np.asarray(year).astype(str).ravel()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def header(self):
+        """Names of all the columns, starting by the year if any and the id"""
+        if self.years is not None:
+            return ['year', 'id'] + self.names
+        return ['id'] + self.names
+
+    def column(self, name):
+        """1d array of a numeric column by name"""
+        return self.columns[self.names.index(name)]
+
+    def items(self):
+        """
+        Columns with their names, years and ids as strings.
+        :return: list of tuples with column name and 1d array
+        """
+        items = [('id', self.ids.astype(str))] + list(zip(self.names, self.columns))
+        if self.years is not None:
+            items.insert(0, ('year', self.years))
+        return items
+
+    def labels(self, start=0, stop=None):
+        """
+        Text written before the values of each row, the id or the year and
+        the id separated by a comma.
+        :return: 1d array of strings
+        """
+        ids = self.ids[start:stop].astype(str)
+        if self.years is None:
+            return ids
+        return np.char.add(np.char.add(self.years[start:stop], ','), ids)
+
+    def block(self, start=0, stop=None, names=None):
+        """
+        Rows of the numeric columns as a 2d array of doubles.
+        :param start: first row
+        :param stop: row after the last one, None for all rows
+        :param names: list of column names, None for all columns
+        :return: (stop - start) x k array
+        """
+        columns = self.columns
+        if names is not None:
+            columns = [self.column(name) for name in names]
+        stop = len(self) if stop is None else stop
+        result = np.empty((stop - start, len(columns)))
+        for index, column in enumerate(columns):
+            result[:, index] = column[start:stop]
+        return result
+
+
+def splitColumns(array):
+    """Views on the columns of a 2d array like, a 1d array being one column"""
+    array = np.asarray(array)
+    if array.ndim == 1:
+        return [array]
+    return [array[:, index] for index in range(array.shape[1])]
+
+
+def exposureNames(pairs):
+    """Column names of the exposure of group pairs, iso_ii or exp_ij"""
+    names = []
+    for i, j in pairs:
+        if i == j:
+            names.append('iso_' + str(i) + str(j))
+        else:
+            names.append('exp_' + str(i) + str(j))
+    return names
+
+
+def joinResults(tract_id, attributes, n_group, locality=None, local_exposure=None,
+                local_dissimilarity=None, local_entropy=None, local_indexh=None,
+                exposure_pairs=None):
+    """
+    Join results on a typed column table and assign names for columns to be
+    used as header for csv file and shapefile output. Local measures given
+    as None are left out, intensity is left out if empty. Measures with a
+    number of rows other than the input are all left out.
+    :param tract_id: n x 1 array with the id of each tract
+    :param attributes: n x (2 + m) matrix with x, y and the population of each group
+    :param n_group: number of groups
+    :param exposure_pairs: list of (i, j) group pairs of the local exposure
+        columns, None for all the pairs
+    :return: ResultTable
+    """
+    names = ['x', 'y']
+    columns = splitColumns(attributes)
+
+    # create new names for groups starting by 0
+    for i in range(n_group):
+        names.append('group_' + str(i))
+
+    measure_names = []
+    measures = []
+
+    # update names with locality if computed
+    if locality is not None and len(locality) != 0:
+        measures.append(locality)
+        for i in range(n_group):
+            measure_names.append('intens_' + str(i))
+
+    # update names with exposure/isolation if computed
+    if local_exposure is not None:
+        measures.append(local_exposure)
+        if exposure_pairs is None:
+            exposure_pairs = exposurePairs(n_group)
+        measure_names.extend(exposureNames(exposure_pairs))
+
+    # update names with dissimilarity if computed
+    if local_dissimilarity is not None:
+        measures.append(local_dissimilarity)
+        measure_names.append('dissimil')
+
+    # update names with entropy if computed
+    if local_entropy is not None:
+        measures.append(local_entropy)
+        measure_names.append('entropy')
+
+    # update names with index H if computed
+    if local_indexh is not None:
+        measures.append(local_indexh)
+        measure_names.append('indexh')
+
+    # add results if they match the input, else only original input
+    measure_columns = []
+    for measure in measures:
+        measure_columns.extend(splitColumns(measure))
+    if (len(measure_columns) == len(measure_names) and
+            all(len(column) == len(columns[0]) for column in measure_columns)):
+        names.extend(measure_names)
+        columns.extend(measure_columns)
+
+    return ResultTable(tract_id, names, columns)
+
+
+def stackResults(results, years):
+    """
+    Long format table of the results of several years on the same tracts,
+    the rows of each year after the ones of the previous year.
+    :param results: list of ResultTable with the same columns, one by year
+    :param years: list with the year of each table
+    :return: ResultTable with a year column
+    """
+    names = results[0].names
+    if any(result.names != names for result in results):
+        raise Exception('Results of every year must have the same columns!')
+
+    year = np.repeat(np.asarray(years).astype(str), [len(result) for result in results])
+    ids = np.concatenate([result.ids for result in results])
+    columns = [np.concatenate([result.column(name) for result in results]) for name in names]
+    return ResultTable(ids, names, columns, year)
+
+
+def fixedText(values, decimals):
+    """
+    Fixed point text of finite doubles, written digit by digit on a byte
+    array so no python string is built by value. Values are rounded after
+    scaling by 10 ** decimals, as the %f format but for the last digit of
+    rare halfway cases.
+    :param values: 2d array of doubles, abs(values) * 10 ** decimals < 2 ** 53
+    :param decimals: number of decimals
+    :return: 3d uint8 array with the text of each value right aligned, NUL
+        bytes on the left
+    """
+    scaled = np.rint(np.abs(values) * 10.0 ** decimals).astype(np.int64)
+    point = 1 if decimals > 0 else 0
+
+    # number of digits of each value, at least one before the point
+    digits = np.ones(scaled.shape, dtype=np.int64)
+    largest = int(scaled.max()) if scaled.size else 0
+    power = 10
+    while power <= largest:
+        digits += scaled >= power
+        power *= 10
+    digits = np.maximum(digits, decimals + 1)
+
+    # sign, digits and point, the last byte is the least significant digit
+    width = 1 + int(digits.max() if digits.size else decimals + 1) + point
+    text = np.zeros(scaled.shape + (width,), dtype=np.uint8)
+    remainder = scaled.copy()
+    for position in range(width - 1 - point):
+        column = width - 1 - position - (point if position >= decimals else 0)
+        present = position < digits
+        text[..., column][present] = ord('0') + (remainder % 10)[present]
+        remainder //= 10
+    if point:
+        text[..., width - 1 - decimals] = ord('.')
+
+    # minus sign before the most significant digit
+    rows, columns = np.nonzero(np.signbit(values))
+    text[rows, columns, width - 1 - point - digits[rows, columns]] = ord('-')
+    return text
+
+
+def csvBlock(result, start, stop, decimals=None):
+    """
+    Text of a block of rows of the local results.
+    :param result: ResultTable from joinResults
+    :param decimals: number of decimals of the values, formatted at once by
+        fixedText. None writes the shortest repr of each double, it is exact
+        but about four times slower. Blocks with values that are not finite
+        or too large for the decimals are written as None
+    :return: encoded text with one line by row
+    """
+    values = result.block(start, stop)
+    if (decimals is not None and np.all(np.isfinite(values)) and
+            np.all(np.abs(values) < 2.0 ** 53 / 10 ** decimals)):
+        ids = result.labels(start, stop)
+        if ids.dtype.kind == 'U':
+            ids = np.char.encode(ids, 'utf-8')
+        ids = np.asarray(ids, dtype=bytes)
+        ids = ids.view(np.uint8).reshape((len(ids), ids.dtype.itemsize))
+
+        # id, then comma and value for each column, NUL padding is dropped
+        text = fixedText(values, decimals)
+        text = np.concatenate((np.full(text.shape[:2] + (1,), ord(','), dtype=np.uint8), text),
+                              axis=2)
+        lines = np.concatenate((ids, text.reshape((len(ids), -1)),
+                                np.full((len(ids), 1), ord('\n'), dtype=np.uint8)), axis=1)
+        return lines[lines != 0].tobytes()
+
+    columns = [result.labels(start, stop).tolist()]
+    for column in values.T:
+        columns.append(list(map(repr, column.tolist())))
+    text = '\n'.join([','.join(row) for row in zip(*columns)]) + '\n'
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return text
+
+
+def writeCsv(path, result, compress=None, decimals=None, values=2 ** 18):
+    """
+    Save local results on a csv file, streamed by blocks of rows so memory
+    stays the same for any number of tracts.
+    :param path: output file name
+    :param result: ResultTable from joinResults
+    :param compress: gzip the file on the fly, None to compress if the name
+        ends with .gz
+    :param decimals: number of decimals of the values, None for the shortest
+        repr that reads back the same double, see csvBlock
+    :param values: number of values formatted by block
+    """
+    if compress is None:
+        compress = path.lower().endswith('.gz')
+    labels = str(', '.join(result.header()))
+    block = max(1, values // len(result.header()))
+
+    f = gzip.open(path, 'wb', 6) if compress else open(path, 'wb')
+    try:
+        f.write(('# ' + labels + '\n').encode('utf-8'))
+        for start in range(0, len(result), block):
+            f.write(csvBlock(result, start, min(start + block, len(result)), decimals))
+    finally:
+        f.close()
+
+
+def arrowModule():
+    """
+    Import pyarrow with its parquet and feather modules on first use.
+    :return: pyarrow module, None if not installed
+    """
+    if 'pyarrow' not in _arrow:
+        try:
+            import pyarrow
+            import pyarrow.feather
+            import pyarrow.parquet
+        except ImportError:  # columnar formats are optional
+            pyarrow = None
+        _arrow['pyarrow'] = pyarrow
+    return _arrow['pyarrow']
+
+
+def outputFormats():
+    """
+    Output formats available, Parquet and Arrow need pyarrow.
+    :return: list of tuples with extension and description
+    """
+    if arrowModule() is None:
+        return [item for item in FORMATS if item[0] not in ('parquet', 'arrow')]
+    return list(FORMATS)
+
+
+def writeNpz(path, result):
+    """
+    Save local results as a compressed numpy archive, one array by column
+    keyed by the column name, ids as strings.
+    :param path: output file name
+    :param result: ResultTable from joinResults
+    """
+    np.savez_compressed(path, **dict(result.items()))
+
+
+def arrowTable(result):
+    """Local results as a pyarrow Table"""
+    pyarrow = arrowModule()
+    if pyarrow is None:
+        raise Exception('Parquet and Arrow output need the pyarrow module!')
+
+    columns = result.items()
+    return pyarrow.Table.from_arrays([pyarrow.array(column) for name, column in columns],
+                                     names=[name for name, column in columns])
+
+
+def writeParquet(path, result):
+    """
+    Save local results as a Parquet file.
+    :param path: output file name
+    """
+    arrowModule().parquet.write_table(arrowTable(result), path)
+
+
+def writeArrow(path, result):
+    """
+    Save local results as an Arrow IPC (Feather version 2) file.
+    :param path: output file name
+    """
+    arrowModule().feather.write_feather(arrowTable(result), path)
+
+
+def outputFormat(path):
+    """
+    Output format of a file name.
+    :param path: output file name
+    :return: extension of one of FORMATS, None if unknown
+    """
+    for extension, label in FORMATS:
+        if path.lower().endswith('.' + extension):
+            return extension
+    return None
+
+
+def writeTable(path, result, decimals=None):
+    """
+    Save local results on the format given by the file extension, one of
+    FORMATS but the GeoPackage.
+    :param path: output file name
+    :param result: ResultTable from joinResults
+    :param decimals: number of decimals of csv values, see writeCsv
+    """
+    extension = outputFormat(path)
+    writers = {'npz': writeNpz, 'parquet': writeParquet, 'arrow': writeArrow}
+    if extension in ('csv', 'csv.gz'):
+        writeCsv(path, result, decimals=decimals)
+    elif extension in writers:
+        writers[extension](path, result)
+    else:
+        raise Exception('Output format not supported!')
+
+
+def writeGlobal(path, global_dissimilarity, global_entropy, global_indexh, global_exposure):
+    """
+    Save global results to a text file.
+    :param path: output file name
+    """
+    with open(path, "w") as f:
+        f.write('Global dissimilarity: ' + str(global_dissimilarity))
+        f.write('\nGlobal entropy: ' + str(global_entropy))
+        f.write('\nGlobal Index H: ' + str(global_indexh))
+        f.write('\nGlobal isolation/exposure: \n')
+        f.write(str(global_exposure))
+
+
+def writeGlobalTable(path, years, results):
+    """
+    Save the global results of several years as a csv table, one row by
+    year, with the global exposure of every group pair. Measures not
+    computed are left empty.
+    :param path: output file name
+    :param years: list with the year of each result
+    :param results: list of dictionaries with the global measures by name
+    """
+    n_group = max([len(np.atleast_2d(result['global_exposure'])) for result in results
+                   if len(result['global_exposure']) != 0] or [0])
+    pairs = exposurePairs(n_group)
+    with open(path, 'w') as f:
+        f.write('# ' + ', '.join(['year', 'dissimil', 'entropy', 'indexh'] +
+                                 exposureNames(pairs)) + '\n')
+        for year, result in zip(years, results):
+            values = []
+            for name in ('global_dissimilarity', 'global_entropy', 'global_indexh'):
+                value = np.ravel(result[name])
+                values.append(repr(float(value[0])) if len(value) == 1 else '')
+            exposure = np.asarray(result['global_exposure'])
+            for i, j in pairs:
+                values.append(repr(float(exposure[i, j])) if exposure.size else '')
+            f.write(','.join([str(year)] + values) + '\n')
+
+
+# column names of the measures tested for significance, local and global
+SIGNIFICANCE_NAMES = [('local_dissimilarity', 'global_dissimilarity', 'dissimil'),
+                      ('local_entropy', 'global_entropy', 'entropy'),
+                      ('local_indexh', 'global_indexh', 'indexh')]
+
+
+def significanceTable(tract_id, significance):
+    """
+    Table of the local measures tested and their p-values, named after the
+    measure with a p_ prefix.
+    :param tract_id: array like with the id of each tract
+    :param significance: dictionary with the observed values and p-values by
+        measure, see segreg_significance.monteCarlo
+    :return: ResultTable
+    """
+    names = []
+    columns = []
+    for local, _, name in SIGNIFICANCE_NAMES:
+        if local in significance['p_value']:
+            names.extend([name, 'p_' + name])
+            columns.extend([significance['observed'][local], significance['p_value'][local]])
+    return ResultTable(tract_id, names, columns)
+
+
+def writeNullTable(path, significance):
+    """
+    Save the null distributions of the global measures tested as a csv
+    table, one row by replicate after the observed values and p-values.
+    :param path: output file name
+    :param significance: dictionary with the observed values, p-values and
+        null distributions by measure, see segreg_significance.monteCarlo
+    """
+    tested = [(name, short) for _, name, short in SIGNIFICANCE_NAMES
+              if name in significance['null']]
+    with open(path, 'w') as f:
+        f.write('# ' + ', '.join(['replicate'] + [short for _, short in tested]) + '\n')
+        for row in ('observed', 'p_value'):
+            values = [repr(float(significance[row][name])) for name, _ in tested]
+            f.write(','.join([row] + values) + '\n')
+        null = [significance['null'][name] for name, _ in tested]
+        for replicate, values in enumerate(zip(*null)):
+            f.write(','.join([str(replicate)] + [repr(float(value)) for value in values]) + '\n')
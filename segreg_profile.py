@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Wall time and peak memory of the computation stages.
+"""
+import functools
+import json
+import sys
+from contextlib import contextmanager
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def residentMemory():
+    """Resident memory of the process in megabytes, None without psutil"""
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss / (1024.0 * 1024.0)
+
+
+def residentPeak():
+    """
+    Peak resident memory of the process since it started in megabytes, None
+    if unknown (on windows). It is not reset by stage.
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes and mac os bytes
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+class StageProfile(object):
+    def __init__(self, memory=True):
+        """
+        Constructor.
+        :param memory: trace allocations to measure the peak memory of each
+            stage. Numpy arrays are traced, memory of worker processes is not.
+            Not available on python 2, where only the change of resident
+            memory (with psutil) and the process peak are kept.
+        """
+        self.memory = memory and tracemalloc is not None
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        Measure a stage run within a with block and append its record to
+        self.stages. The record is given to the block, which may add to it.
+        :param name: stage name
+        :param info: problem size and parameters stored with the record
+        """
+        record = {'stage': name}
+        record.update(info)
+        started = False
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started = True
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        resident = residentMemory()
+
+        start = default_timer()
+        try:
+            yield record
+        finally:
+            record['seconds'] = default_timer() - start
+            if self.memory:
+                record['peak_mb'] = (tracemalloc.get_traced_memory()[1] - base) / (1024.0 * 1024.0)
+                if started:
+                    tracemalloc.stop()
+            if resident is not None:
+                record['rss_mb'] = residentMemory() - resident
+            record['process_peak_mb'] = residentPeak()
+            self.stages.append(record)
+
+    def clear(self):
+        """Forget the stages recorded, a stage still running is kept"""
+        del self.stages[:]
+
+    def summary(self):
+        """
+        Text table with the stages recorded.
+        :return: string with one line by stage
+        """
+        def number(value, format):
+            return '-' if value is None else format % value
+
+        lines = ['%-18s %9s %9s %9s %11s %8s %6s  %s' % ('Stage', 'Seconds', 'Peak MB',
+                                                        'RSS +MB', 'Process MB', 'Tracts',
+                                                        'Groups', 'Parameters')]
+        for record in self.stages:
+            parameters = ', '.join('%s=%s' % (key, record[key])
+                                   for key in ('bandwidth', 'kernel', 'engine', 'precision')
+                                   if record.get(key) is not None)
+            lines.append('%-18s %9s %9s %9s %11s %8s %6s  %s' % (
+                record['stage'], number(record['seconds'], '%.3f'),
+                number(record.get('peak_mb'), '%.1f'), number(record.get('rss_mb'), '%.1f'),
+                number(record.get('process_peak_mb'), '%.1f'), number(record.get('n'), '%d'),
+                number(record.get('groups'), '%d'), parameters))
+
+        total = sum(record['seconds'] for record in self.stages)
+        lines.append('%-18s %9.3f' % ('Total', total))
+        return '\n'.join(lines)
+
+    def writeLog(self, path, **info):
+        """
+        Append the stages recorded as a single JSON line to a log file.
+        :param path: log file name
+        :param info: values stored with the stages, as date or plugin version
+        """
+        record = dict(info)
+        record['stages'] = self.stages
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def profiled(name):
+    """
+    Decorator measuring a method as a stage of the StageProfile found at
+    self.profile. The dictionary returned by self.problemSize() is added to
+    the record once the method returns, and self.showProfile() is called
+    when the record is stored.
+    :param name: stage name
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                with self.profile.stage(name) as record:
+                    try:
+                        return method(self, *args, **kwargs)
+                    finally:
+                        record.update(self.problemSize())
+            finally:
+                self.showProfile()
+        return wrapper
+    return decorator
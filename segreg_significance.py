@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Monte Carlo significance of the local measures. Random populations are
+ drawn by batches of replicates, the groups of a whole batch go through the
+ weight operator in one product and the measures are computed on arrays of
+ replicate x tract x group, so no measure is called by replicate.
+"""
+import multiprocessing
+
+import numpy as np
+
+# random population models
+NULL_MODELS = ['permutation', 'multinomial']
+
+# local measures tested, with the global measure summing them up
+TESTED = ['local_dissimilarity', 'local_entropy', 'local_indexh']
+GLOBALS = {'local_dissimilarity': 'global_dissimilarity',
+           'local_entropy': 'global_entropy',
+           'local_indexh': 'global_indexh'}
+
+# side of the test by measure: segregation is high dissimilarity and
+# index H, but low entropy
+TAILS = {'local_dissimilarity': 1, 'global_dissimilarity': 1,
+         'local_entropy': -1, 'global_entropy': -1,
+         'local_indexh': 1, 'global_indexh': 1}
+
+# global measures left unchanged by the null model, they are not tested
+FIXED = {'permutation': ['global_entropy'], 'multinomial': []}
+
+# arrays of replicate x tract x group held at once by a batch
+BATCH_ARRAYS = 8
+
+# operator and population shared with the worker processes, see _initWorker
+_worker = {}
+
+
+def randomPopulation(pop, method, rng):
+    """
+    Draw a random population under the null hypothesis of no segregation.
+    :param pop: n x m array with the population of each group by tract
+    :param method: 'permutation' moves the whole population of the tracts to
+        random tracts, 'multinomial' keeps the total of each tract (rounded)
+        and draws its groups with the shares of the whole area
+    :param rng: numpy RandomState
+    :return: n x m array
+    """
+    if method == 'permutation':
+        return pop[rng.permutation(len(pop))]
+    if method != 'multinomial':
+        raise Exception('Unknown null model %s!' % method)
+
+    # multinomial draws of all the tracts at once, as a binomial by group of
+    # what is left of the tract given the share of the groups left
+    share = np.sum(pop, axis=0) / np.sum(pop)
+    left = np.rint(np.sum(pop, axis=1)).astype(np.int64)
+    random = np.empty(pop.shape)
+    share_left = 1.0
+    for group in range(pop.shape[1] - 1):
+        probability = min(1.0, share[group] / share_left) if share_left > 0 else 0.0
+        random[:, group] = rng.binomial(left, probability)
+        left -= random[:, group].astype(np.int64)
+        share_left -= share[group]
+    random[:, -1] = left
+    return random
+
+
+def batchIntensity(operator, pop):
+    """
+    Population intensity of a batch of replicates in one operator product.
+    :param operator: WeightOperator or LatticeOperator, None for the non
+        spatial version (the population itself)
+    :param pop: replicate x tract x group array
+    :return: array of the same shape
+    """
+    if operator is None:
+        return pop
+
+    n_replicate, n_location, n_group = pop.shape
+    columns = pop.transpose(1, 0, 2).reshape((n_location, n_replicate * n_group))
+    locality = np.asarray(operator.apply(columns)[0], dtype=float)
+    return locality.reshape((n_location, n_replicate, n_group)).transpose(1, 0, 2)
+
+
+def batchMeasures(pop, locality, measures=TESTED):
+    """
+    Local measures and their global version for a batch of replicates, with
+    the formulas of measureRows, globalEntropy and localIndexH in double
+    precision.
+    :param pop: replicate x tract x group array with the population
+    :param locality: array of the same shape with the population intensity
+    :param measures: list of names from TESTED
+    :return: dictionary with replicate x tract arrays of the local measures
+        and replicate arrays of the global ones, by name
+    """
+    pop_sum = np.sum(pop, axis=2)
+    group_total = np.sum(pop, axis=1)
+    pop_total = np.sum(pop_sum, axis=1)
+    source_sum = np.sum(locality, axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportion = locality / source_sum[:, :, None]
+
+    results = {}
+    if 'local_dissimilarity' in measures:
+        tm = group_total / pop_total[:, None]
+        index_i = np.sum(tm * (1 - tm), axis=1)
+        local_diss = np.sum(np.fabs(proportion - tm[:, None, :]), axis=2) * pop_sum
+        local_diss = np.nan_to_num(local_diss / (2 * pop_total * index_i)[:, None])
+        results['local_dissimilarity'] = local_diss
+        results['global_dissimilarity'] = np.sum(local_diss, axis=1)
+
+    if 'local_entropy' in measures or 'local_indexh' in measures:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = proportion * np.log(1 / proportion)
+            share = group_total / pop_total[:, None]
+            global_entropy = np.sum(share * np.log(1 / share), axis=1)
+        terms[~np.isfinite(terms)] = 0
+        local_entropy = np.sum(terms, axis=2)
+        if 'local_entropy' in measures:
+            results['local_entropy'] = local_entropy
+            results['global_entropy'] = global_entropy
+        if 'local_indexh' in measures:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                local_indexh = (pop_sum * (global_entropy[:, None] - local_entropy) /
+                                (global_entropy * pop_total)[:, None])
+            results['local_indexh'] = local_indexh
+            results['global_indexh'] = np.sum(local_indexh, axis=1)
+    return results
+
+
+def replicateBatch(pop, operator, measures, method, seed, first, last):
+    """
+    Measures of the replicates first to last - 1. Each replicate has its own
+    random state seeded with [seed, replicate], so random populations don't
+    depend on the batch size or on the number of processes.
+    :return: dictionary of batchMeasures
+    """
+    random = np.empty((last - first,) + pop.shape)
+    for index, replicate in enumerate(range(first, last)):
+        random[index] = randomPopulation(pop, method, np.random.RandomState([seed, replicate]))
+    return batchMeasures(random, batchIntensity(operator, random), measures)
+
+
+def _initWorker(pop, operator, measures, method, seed):
+    """Keep the arguments shared by the batches of a worker process"""
+    _worker.update(pop=pop, operator=operator, measures=measures, method=method, seed=seed)
+
+
+def _batchWorker(replicates):
+    """Compute one batch of replicates on a worker process"""
+    return replicateBatch(_worker['pop'], _worker['operator'], _worker['measures'],
+                          _worker['method'], _worker['seed'], replicates[0], replicates[1])
+
+
+def batchSize(n_location, n_group, memory=None):
+    """
+    Replicates by batch within a memory budget.
+    :param memory: memory budget in megabytes, None for a single batch
+    :return: number of replicates, None for all of them
+    """
+    if memory is None:
+        return None
+    size = BATCH_ARRAYS * 8.0 * n_location * n_group
+    return max(1, int(memory * 1024 * 1024 // size))
+
+
+def monteCarlo(pop, operator=None, measures=TESTED, replicates=999, method=None, seed=0,
+               memory=None, workers=1, progress=None):
+    """
+    Pseudo p-values of the local measures against random populations. The
+    p-value of a tract is (1 + k) / (1 + replicates), k being the replicates
+    at least as segregated as the observed value, see TAILS. Values that are
+    not finite have no p-value (nan). Only the counts are kept by tract, the
+    global measures are kept for every replicate as null distributions.
+    Moving whole tracts only tests the spatial measures, the non spatial
+    ones and global entropy being the same for every permutation, so the
+    permutation model needs an operator and global entropy is left out.
+    :param pop: n x m array like with the population of each group by tract
+    :param operator: WeightOperator or LatticeOperator of the intensity, None
+        for the non spatial measures
+    :param measures: list of names from TESTED
+    :param replicates: number of random populations
+    :param method: one of NULL_MODELS, see randomPopulation, None for
+        permutation with an operator and multinomial without
+    :param seed: integer seed of the random states
+    :param memory: memory budget in megabytes of each batch of replicates
+    :param workers: number of processes sharing the batches
+    :param progress: optional callable receiving the replicates done and the
+        total, it may raise an exception to stop the computation
+    :return: dictionary with 'observed' (measures of the population by name),
+        'p_value' (n arrays by local measure and floats by global measure) and
+        'null' (replicate arrays by global measure)
+    """
+    pop = np.asarray(pop, dtype=float)
+    for name in measures:
+        if name not in TESTED:
+            raise Exception('No significance test for %s!' % name)
+    if method is None:
+        method = 'multinomial' if operator is None else 'permutation'
+    if method not in NULL_MODELS:
+        raise Exception('Unknown null model %s!' % method)
+    if method == 'permutation' and operator is None:
+        raise Exception('Permutation of tracts does not test non spatial measures, '
+                        'use the multinomial model!')
+
+    observed = batchMeasures(pop[None], batchIntensity(operator, pop[None]), measures)
+    observed = dict((name, value[0]) for name, value in observed.items()
+                    if name not in FIXED[method])
+    count = dict((name, np.zeros(np.shape(value))) for name, value in observed.items())
+    null = dict((GLOBALS[name], []) for name in measures if GLOBALS[name] in observed)
+
+    batch = batchSize(pop.shape[0], pop.shape[1], memory) or replicates
+    ranges = [(first, min(first + batch, replicates)) for first in range(0, replicates, batch)]
+    pool = None
+    if workers > 1 and len(ranges) > 1:
+        pool = multiprocessing.Pool(min(workers, len(ranges)), _initWorker,
+                                    (pop, operator, measures, method, seed))
+        batches = pool.imap(_batchWorker, ranges)
+    else:
+        batches = (replicateBatch(pop, operator, measures, method, seed, first, last)
+                   for first, last in ranges)
+
+    try:
+        for (first, last), results in zip(ranges, batches):
+            for name, value in results.items():
+                if name not in observed:
+                    continue
+                tail = TAILS[name]
+                count[name] += np.sum(tail * value >= tail * observed[name], axis=0)
+                if name in null:
+                    null[name].append(value)
+            if progress is not None:
+                progress(last, replicates)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    p_value = {}
+    for name, value in observed.items():
+        p_value[name] = np.where(np.isfinite(value), (1.0 + count[name]) / (1.0 + replicates),
+                                 np.nan)
+        if np.ndim(value) == 0:
+            p_value[name] = float(p_value[name])
+    null = dict((name, np.concatenate(values)) for name, values in null.items())
+    return {'observed': observed, 'p_value': p_value, 'null': null}
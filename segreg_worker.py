@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Segreg
+                                 A QGIS plugin
+ This plugin computes spatial and non spatial segregation measures
+                              -------------------
+        begin                : 2017-01-25
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Sandro Sousa / USP-UFABC
+        email                : sandrofsousa@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Background execution of the computations, so QGIS is not frozen while
+ intensity and measures are computed.
+"""
+import traceback
+
+from PyQt4.QtCore import QObject, pyqtSignal, pyqtSlot
+
+
+class Cancelled(Exception):
+    """Raised through the progress callback when the user cancels a task"""
+
+
+class SegregWorker(QObject):
+    # percentage done, emitted as row blocks complete
+    progress = pyqtSignal(int)
+    # return value of the function
+    completed = pyqtSignal(object)
+    # traceback of an exception raised by the function
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, function):
+        """
+        Constructor.
+        :param function: callable run on the worker thread, it receives a
+            progress callback to be called with the work done and the total.
+            The callback raises Cancelled once cancel is requested, so the
+            computation stops at its next block.
+        """
+        super(SegregWorker, self).__init__()
+        self.function = function
+        self.stopped = False
+
+    @pyqtSlot()
+    def run(self):
+        """Run the function, to be connected to the started signal of a QThread"""
+        try:
+            result = self.function(self.report)
+        except Cancelled:
+            self.cancelled.emit()
+        except Exception:
+            self.failed.emit(traceback.format_exc())
+        else:
+            self.completed.emit(result)
+
+    def report(self, done, total):
+        """Progress callback given to the function"""
+        if self.stopped:
+            raise Cancelled()
+        self.progress.emit(int(100.0 * done / max(total, 1)))
+
+    def cancel(self):
+        """Request the function to stop, called from the GUI thread"""
+        self.stopped = True
@@ -0,0 +1,2 @@
+# coding=utf-8
+"""Headless tests of Segreg, run without QGIS (make test)."""
@@ -0,0 +1,174 @@
+# coding=utf-8
+"""
+Headless tests of the intensity engines and of the result writers. Every
+engine, precision and process count is checked against the dense double
+precision intensity, and every output format is read back.
+"""
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from segreg_intensity import WeightOperator, localityMatrix
+from segreg_output import arrowModule, joinResults, writeGlobal, writeTable
+
+
+def randomLayer(n=400, groups=3, seed=0):
+    """Random tract centroids and populations"""
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 3000, (n, 2)), rng.poisson(20, (n, groups)).astype(float)
+
+
+def latticeLayer(groups=3, seed=0):
+    """Tract centroids on a 20 x 15 grid of 100 m cells and populations"""
+    rng = np.random.RandomState(seed)
+    x, y = np.meshgrid(np.arange(20) * 100.0, np.arange(15) * 100.0)
+    return np.c_[x.ravel(), y.ravel()], rng.poisson(20, (x.size, groups)).astype(float)
+
+
+class IntensityTest(unittest.TestCase):
+    """Engines against the dense double precision intensity"""
+
+    def setUp(self):
+        self.location, self.pop = randomLayer()
+
+    def reference(self, bandwidth, weightmethod, location=None, pop=None):
+        if location is None:
+            location, pop = self.location, self.pop
+        return localityMatrix(location, pop, bandwidth, weightmethod, engine='dense')[0]
+
+    def test_streaming(self):
+        # one megabyte splits the rows in blocks
+        for weightmethod in (1, 2, 3):
+            locality, error = localityMatrix(self.location, self.pop, 400, weightmethod,
+                                             memory=1, engine='dense')
+            np.testing.assert_allclose(locality, self.reference(400, weightmethod), rtol=1e-12)
+            self.assertEqual(error, 0.0)
+
+    def test_sparse(self):
+        for weightmethod in (2, 3):
+            locality, error = localityMatrix(self.location, self.pop, 400, weightmethod,
+                                             engine='sparse')
+            np.testing.assert_allclose(locality, self.reference(400, weightmethod), rtol=1e-12)
+            self.assertEqual(error, 0.0)
+
+    def test_sparse_truncated(self):
+        locality, error = localityMatrix(self.location, self.pop, 400, 1, engine='sparse',
+                                         tolerance=1e-6)
+        difference = np.max(np.abs(locality - self.reference(400, 1)))
+        self.assertGreater(error, 0.0)
+        self.assertLessEqual(difference, error)
+
+    def test_parallel(self):
+        for engine, weightmethod in (('dense', 1), ('sparse', 2)):
+            locality, error = localityMatrix(self.location, self.pop, 400, weightmethod,
+                                             engine=engine, workers=2)
+            np.testing.assert_allclose(locality, self.reference(400, weightmethod), rtol=1e-12)
+
+    def test_fft(self):
+        location, pop = latticeLayer()
+        for weightmethod in (1, 2, 3):
+            locality, error = localityMatrix(location, pop, 300, weightmethod, engine='fft')
+            reference = self.reference(300, weightmethod, location, pop)
+            np.testing.assert_allclose(locality, reference, rtol=1e-12)
+            self.assertEqual(error, 0.0)
+
+        locality, error = localityMatrix(location, pop, 300, 1, engine='fft', tolerance=1e-6)
+        difference = np.max(np.abs(locality - self.reference(300, 1, location, pop)))
+        self.assertLessEqual(difference, error)
+
+    def test_float32(self):
+        for engine, weightmethod in (('dense', 1), ('sparse', 2)):
+            locality, error = localityMatrix(self.location, self.pop, 400, weightmethod,
+                                             engine=engine, dtype=np.float32)
+            self.assertEqual(locality.dtype, np.float32)
+            np.testing.assert_allclose(locality, self.reference(400, weightmethod), rtol=1e-5)
+
+    def test_operator(self):
+        for operator in (WeightOperator.full(self.location, [400], 2)[0],
+                         WeightOperator.sparse(self.location, [400], 2)[0]):
+            locality, error = operator.apply(self.pop)
+            np.testing.assert_allclose(locality, self.reference(400, 2), rtol=1e-12)
+
+
+class OutputTest(unittest.TestCase):
+    """Local and global results written and read back"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        location, pop = randomLayer(n=50, groups=2)
+        locality = localityMatrix(location, pop, 400, 1)[0]
+        tract_id = np.array([['tract_%d' % i] for i in range(50)])
+        self.result = joinResults(tract_id, np.asmatrix(np.c_[location, pop]), 2, locality,
+                                  local_entropy=np.random.RandomState(1).uniform(size=50))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def assertTable(self, columns):
+        """Check columns read back by name against the result table"""
+        self.assertEqual(list(columns), self.result.header())
+        for name, column in self.result.items():
+            if name == 'id':
+                self.assertEqual([str(value) for value in columns[name]], list(column))
+            else:
+                np.testing.assert_array_equal(np.asarray(columns[name], dtype=float), column)
+
+    def readCsv(self, f):
+        lines = [line.decode('utf-8').strip() for line in f]
+        names = lines[0].lstrip('# ').split(', ')
+        rows = [line.split(',') for line in lines[1:]]
+        return dict((name, [row[index] for row in rows]) for index, name in enumerate(names))
+
+    def test_csv(self):
+        writeTable(self.path('results.csv'), self.result)
+        with open(self.path('results.csv'), 'rb') as f:
+            self.assertTable(self.readCsv(f))
+
+    def test_csv_gz(self):
+        writeTable(self.path('results.csv.gz'), self.result)
+        with gzip.open(self.path('results.csv.gz'), 'rb') as f:
+            self.assertTable(self.readCsv(f))
+
+    def test_csv_decimals(self):
+        writeTable(self.path('results.csv'), self.result, decimals=4)
+        with open(self.path('results.csv'), 'rb') as f:
+            columns = self.readCsv(f)
+        np.testing.assert_allclose(np.asarray(columns['intens_0'], dtype=float),
+                                   self.result.column('intens_0'), atol=5e-5)
+
+    def test_npz(self):
+        writeTable(self.path('results.npz'), self.result)
+        with np.load(self.path('results.npz')) as data:
+            columns = dict((name, data[name]) for name in self.result.header())
+        self.assertTable(columns)
+
+    def test_arrow(self):
+        pyarrow = arrowModule()
+        if pyarrow is None:
+            self.skipTest('pyarrow is not installed')
+
+        writeTable(self.path('results.parquet'), self.result)
+        self.assertTable(pyarrow.parquet.read_table(self.path('results.parquet')).to_pydict())
+        writeTable(self.path('results.arrow'), self.result)
+        self.assertTable(pyarrow.feather.read_table(self.path('results.arrow')).to_pydict())
+
+    def test_global(self):
+        writeGlobal(self.path('results_global.csv'), 0.25, 1.0 / 3, 0.125, np.eye(2))
+        with open(self.path('results_global.csv')) as f:
+            lines = f.read().split('\n')
+        self.assertEqual(lines[0], 'Global dissimilarity: 0.25')
+        self.assertAlmostEqual(float(lines[1].split(': ')[1]), 1.0 / 3, places=10)
+        self.assertEqual(lines[2], 'Global Index H: 0.125')
+        self.assertEqual(lines[3], 'Global isolation/exposure: ')
+        self.assertEqual(len(lines), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()